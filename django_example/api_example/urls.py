@@ -18,6 +18,7 @@ from django.contrib import admin
 
 from globals.api_resources import Resource
 from rest_api.resources import BaseResource
+from rest_api.schema import schema_view
 from sample_app.handlers import IndexHandler, ObjectHandler, SampleHandler
 
 urlpatterns = [
@@ -29,4 +30,7 @@ urlpatterns = [
 
     # Only this api calls your customize "Resource" method "email_exception"
     url(r'^api/sample/$', Resource(handler=SampleHandler)),
+
+    # OpenAPI schema of the apis above
+    url(r'^api/schema/$', schema_view),
 ]
@@ -1,6 +1,5 @@
 
 from rest_api.handler import BaseIndexHandler, BaseObjectHandler, BaseHandler
-from rest_api.utils import process_integer
 from rest_api.errors import GlobalAPIException
 from globals import api_errors
 
@@ -10,6 +9,8 @@ class IndexHandler(BaseIndexHandler):
     allowed_methods = ('GET', 'POST')
     query_model = SampleModel
     read_auth_exempt = True
+    trusted_payload = True
+    values_rows = True
 
     # for POST function
     create_kwargs = ('title', 'sequence')
@@ -32,9 +33,7 @@ class ObjectHandler(BaseObjectHandler):
     create_kwargs = ('title', 'sequence')
     form_fields = ('title', 'sequence')
     update_instead_save = True
-
-    def create_validate(self, query_dict, **kwargs):
-        process_integer(query_dict, ['sequence'])
+    field_types = {'sequence': 'int'}
 
 
 class SampleHandler(BaseHandler):
@@ -1,6 +1,738 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import base64
+import json
+import os
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+from multiprocessing.pool import ThreadPool
+from unittest import skipUnless
 
-# Create your tests here.
+from django.conf.urls import url
+from django.core.cache import cache
+from django.db import connection, connections
+from django.contrib.auth.models import AnonymousUser, Group, Permission, User
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils.translation import ugettext_lazy
+
+from rest_api import batch, json_codec, response_cache, schema, throttle
+from rest_api.batch import BatchHandler
+from rest_api import errors as api_errors
+from rest_api.emitters import JSONEmitter
+from rest_api.piston.handler import typemapper, serialization_plans
+from rest_api.resources import BaseResource, make_error_response
+from rest_api.serializers import JSONModel, JSONSpec
+from rest_api.throttle import SlidingWindow
+from rest_api.utils import make_coercer, parse_fields
+from rest_api.handler import BaseHandler, BaseIndexHandler, BaseObjectHandler, estimate_count, supports_returning
+from sample_app.handlers import IndexHandler, ObjectHandler
+from sample_app.models import SampleModel
+
+
+class CursorHandler(IndexHandler):
+    cursor_fields = ('-sequence', 'id')
+
+
+class WhoAmIHandler(BaseHandler):
+    allowed_methods = ('GET', )
+    read_auth_exempt = True
+    cache_timeout = 60
+
+    def read(self, request, **kwargs):
+        return {'user': unicode(request.user)}
+
+
+class PrivateWhoAmIHandler(WhoAmIHandler):
+    read_auth_exempt = False
+
+
+class AdminWhoAmIHandler(PrivateWhoAmIHandler):
+    superuser_only = True
+
+
+class TaggedHandler(BaseHandler):
+    allowed_methods = ('GET', )
+    read_auth_exempt = True
+    cache_timeout = 60
+
+    def etag(self, request, *args, **kwargs):
+        return 'v1'
+
+    def read(self, request, **kwargs):
+        return {'ok': True}
+
+
+class UntrustedHandler(BaseHandler):
+    allowed_methods = ('GET', )
+    read_auth_exempt = True
+    fields = ('id', 'title', 'created')
+
+    def read(self, request, **kwargs):
+        payload = {'price': Decimal('1.50'), 'when': datetime(2020, 1, 2, 3, 4, 5), 'label': ugettext_lazy('Name'),
+                   'items': [1, 'two', None]}
+        if request.GET.get('model'):
+            payload['object'] = SampleModel.objects.get(sequence=1)
+            payload['objects'] = SampleModel.objects.filter(sequence__lt=3)
+        return payload
+
+
+class TrustedHandler(UntrustedHandler):
+    trusted_payload = True
+
+
+class ThrottledHandler(BaseHandler):
+    allowed_methods = ('GET', )
+    read_auth_exempt = True
+    rate_limits = (SlidingWindow(2, 60), )
+
+    def read(self, request, **kwargs):
+        return {'ok': True}
+
+
+class BulkHandler(IndexHandler):
+    create_auth_exempt = True
+    bulk_create_size = 100
+
+
+class BulkObjectHandler(ObjectHandler):
+    create_auth_exempt = True
+    bulk_create_size = 100
+
+
+class PrivateSampleModel(SampleModel):
+    class Meta:
+        proxy = True
+
+    @classmethod
+    def viewables(cls, user):
+        return cls.objects.filter(sequence__lt=2)
+
+
+class PagedHandler(IndexHandler):
+    page_info = True
+    count_total = 'exact'
+
+
+class ApproximatePagedHandler(PagedHandler):
+    count_total = 'approximate'
+
+
+class SpecPermission(JSONModel, Permission):
+    json_spec = JSONSpec(
+        fields=('id', 'name', ('app', 'content_type__app_label'), 'label'),
+        detail_fields=('codename', 'content_type'),
+        computed={'label': lambda row, request: '%s: %s' % (row['app'], row['name'])})
+
+    class Meta:
+        proxy = True
+
+
+class SpecObjectsHandler(BaseIndexHandler):
+    allowed_methods = ('GET', )
+    query_model = SpecPermission
+    read_auth_exempt = True
+    sparse_fields = ('id', 'name', 'app', 'label', 'codename', 'content_type')
+
+
+class SpecValuesHandler(SpecObjectsHandler):
+    values_rows = True
+
+
+class SetHandler(IndexHandler):
+    allowed_methods = ('GET', 'PATCH', 'DELETE')
+    create_auth_exempt = delete_auth_exempt = True
+    form_fields = ('title', )
+    read_kwargs = allowed_filter = ('sequence', )
+
+
+class PrivateSetHandler(SetHandler):
+    query_model = PrivateSampleModel
+    about_privacy = True
+
+
+class ReadBackHandler(ObjectHandler):
+    update_returning = False
+
+
+class PermissionHandler(BaseObjectHandler):
+    query_model = Permission
+    select_related = ('content_type', )
+    update_instead_save = True
+
+
+class ConcurrentBatchHandler(BatchHandler):
+    concurrent_reads = 2
+
+
+class VersionedHandler(ObjectHandler):
+    create_auth_exempt = True
+    version_field = 'sequence'
+
+
+urlpatterns = [
+    url(r'^api/cursor/$', BaseResource(handler=CursorHandler)),
+    url(r'^api/whoami/$', BaseResource(handler=WhoAmIHandler)),
+    url(r'^api/private_whoami/$', BaseResource(handler=PrivateWhoAmIHandler)),
+    url(r'^api/admin_whoami/$', BaseResource(handler=AdminWhoAmIHandler)),
+    url(r'^api/tagged/$', BaseResource(handler=TaggedHandler)),
+    url(r'^api/untrusted/$', BaseResource(handler=UntrustedHandler)),
+    url(r'^api/trusted/$', BaseResource(handler=TrustedHandler)),
+    url(r'^api/throttled/$', BaseResource(handler=ThrottledHandler)),
+    url(r'^api/bulk/$', BaseResource(handler=BulkHandler)),
+    url(r'^api/bulk/(?P<object_id>\w+)/$', BaseResource(handler=BulkObjectHandler)),
+    url(r'^api/paged/$', BaseResource(handler=PagedHandler)),
+    url(r'^api/approximate_paged/$', BaseResource(handler=ApproximatePagedHandler)),
+    url(r'^api/spec_objects/$', BaseResource(handler=SpecObjectsHandler)),
+    url(r'^api/spec_values/$', BaseResource(handler=SpecValuesHandler)),
+    url(r'^api/set/$', BaseResource(handler=SetHandler)),
+    url(r'^api/private_set/$', BaseResource(handler=PrivateSetHandler)),
+    url(r'^api/batch/$', BaseResource(handler=BatchHandler)),
+    url(r'^api/concurrent_batch/$', BaseResource(handler=ConcurrentBatchHandler)),
+    url(r'^api/versioned/(?P<object_id>\w+)/$', BaseResource(handler=VersionedHandler)),
+]
+
+
+def make_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        for i in range(5):
+            SampleModel.objects.create(title='t%d' % i, sequence=i)
+
+    def get_json(self, path, data=None, status=200, **extra):
+        response = self.client.get(path, data or {}, **extra)
+        self.assertEqual(response.status_code, status, response.content)
+        return json.loads(response.content)
+
+    def send_json(self, method, path, data, status=200):
+        response = getattr(self.client, method)(path, json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, status, response.content)
+        return json.loads(response.content)
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class CursorTests(APITestCase):
+    def test_next_page(self):
+        first = self.get_json('/api/cursor/', {'limit': 2})
+        self.assertEqual([row['sequence'] for row in first['data']], [4, 3])
+        second = self.get_json('/api/cursor/', {'limit': 2, 'cursor': first['info']['next_cursor']})
+        self.assertEqual([row['sequence'] for row in second['data']], [2, 1])
+
+    def test_malformed_cursor(self):
+        self.get_json('/api/cursor/', {'cursor': '!!!'}, status=400)
+        self.get_json('/api/cursor/', {'cursor': make_cursor([1])}, status=400)
+
+    def test_tampered_cursor_values(self):
+        self.get_json('/api/cursor/', {'cursor': make_cursor(['x', 'x'])}, status=400)
+        self.get_json('/api/cursor/', {'cursor': make_cursor([{}, 1])}, status=400)
+
+
+class SparseFieldsTests(TestCase):
+    def test_fields_are_normalized(self):
+        self.assertEqual(parse_fields('title, id,title', ('id', 'title')), ('id', 'title'))
+
+    def test_plan_cache_ignores_field_order(self):
+        serialization_plans.clear()
+        emitter = JSONEmitter(None, typemapper, IndexHandler(), anonymous=False)
+        first = emitter.model_plan(SampleModel, ('id', 'title'))
+        self.assertIs(emitter.model_plan(SampleModel, ('title', 'id')), first)
+        self.assertEqual(len(serialization_plans), 1)
+
+
+class StreamTests(TestCase):
+    def test_iterate_prefetches_per_chunk(self):
+        group = Group.objects.create(name='g')
+        for i in range(5):
+            User.objects.create(username='u%d' % i).groups.add(group)
+        handler = BaseIndexHandler()
+        handler.stream_chunk_size = 2
+
+        with self.assertNumQueries(4):
+            users = list(handler.iterate(User.objects.order_by('id').prefetch_related('groups')))
+            names = [[g.name for g in user.groups.all()] for user in users]
+        self.assertEqual(names, [['g']] * 5)
+
+
+class RequestSchemaTests(TestCase):
+    def test_subclasses_compile_their_own_schema(self):
+        class Parent(BaseHandler):
+            read_kwargs = ('a', )
+            create_kwargs = ('a', )
+            field_types = {'a': 'int'}
+
+        class Child(Parent):
+            read_kwargs = ('a', 'b')
+            field_types = {'a': 'float'}
+
+        class GrandChild(Child):
+            create_kwargs = ('c', )
+            required_fields = ('c', )
+
+        # The subclasses are compiled after their parent
+        parent = Parent().request_schema()
+        child, grand_child = Child().request_schema(), GrandChild().request_schema()
+        self.assertEqual([name for name, required, coerce in parent.read], ['a'])
+        self.assertEqual([name for name, required, coerce in child.read], ['a', 'b'])
+        self.assertEqual(parent.read[0][2]('2.5'), 2)
+        self.assertEqual(child.read[0][2]('2.5'), 2.5)
+        self.assertEqual([(name, required) for name, required, coerce in grand_child.create], [('c', True)])
+        self.assertEqual([(name, required) for name, required, coerce in child.create], [('a', False)])
+        self.assertIs(Parent().request_schema(), parent)
+        self.assertIsNot(child, parent)
+
+
+class CoercerTests(TestCase):
+    CASES = [
+        ('int', [('3', 3), ('3.7', 3), (4, 4)], ['abc', '', True, None]),
+        ('float', [('2.5', 2.5), (1, 1.0), ('', None)], ['abc', [1]]),
+        ('bool', [('true', True), ('1', True), (True, True), ('false', False), ('0', False), ('', False)],
+         ['yes', '2', None]),
+        ('list', [('a,b', ['a', 'b']), ('', []), ([1, 2], [1, 2])], [5, {'a': 1}]),
+        ('timestamp', [('0', datetime.fromtimestamp(0)), (1.5, datetime.fromtimestamp(1.5))], ['abc', '1e30']),
+        ('latlon', [('1.5,2', (1.5, 2.0)), ([-90, 180], (-90.0, 180.0))], ['1', 'a,b', '91,0', '0,181', 'nan,0', '']),
+        (((1, 'one'), (2, 'two')), [('1', 1), (2, 2)], ['3', 'one', None]),
+    ]
+
+    def test_coercers(self):
+        for field_type, accepted, rejected in self.CASES:
+            coerce = make_coercer('the_param', field_type)
+            for value, expected in accepted:
+                self.assertEqual(coerce(value), expected, (field_type, value))
+            for value in rejected:
+                with self.assertRaises(api_errors.GlobalAPIException) as raised:
+                    coerce(value)
+                self.assertEqual(raised.exception.code, api_errors.ERROR_GENERAL_BAD_PARA_FORMAT)
+                self.assertIn("'the_param'", raised.exception.debug, (field_type, value))
+
+    def test_unknown_type(self):
+        self.assertRaises(ValueError, make_coercer, 'the_param', 'decimal')
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class ResponseCacheTests(APITestCase):
+    def setUp(self):
+        super(ResponseCacheTests, self).setUp()
+        cache.clear()
+        User.objects.create_user('alice', password='pw')
+        User.objects.create_user('bob', password='pw')
+
+    def test_users_dont_share_cached_responses(self):
+        self.assertEqual(self.get_json('/api/whoami/')['user'], 'AnonymousUser')
+
+        self.client.login(username='alice', password='pw')
+        self.assertEqual(self.get_json('/api/whoami/')['user'], 'alice')
+
+        self.client.login(username='bob', password='pw')
+        self.assertEqual(self.get_json('/api/whoami/')['user'], 'bob')
+
+        self.client.logout()
+        self.assertEqual(self.get_json('/api/whoami/')['user'], 'AnonymousUser')
+
+    def test_each_user_has_own_entry(self):
+        request = RequestFactory().get('/api/private_whoami/')
+        handler = PrivateWhoAmIHandler()
+        keys = set()
+        for user in User.objects.all():
+            request.user = user
+            keys.add(response_cache.make_key(handler, request, (), {}))
+            self.client.force_login(user)
+            self.assertEqual(self.get_json('/api/private_whoami/')['user'], user.username)
+        self.assertEqual(len(keys), 2)
+        self.assertEqual([response_cache.get_response(key) is not None for key in keys], [True, True])
+
+    def test_refused_requests_are_not_cached(self):
+        request = RequestFactory().get('/api/private_whoami/')
+        request.user = AnonymousUser()
+        self.assertIsNone(response_cache.make_key(PrivateWhoAmIHandler(), request, (), {}))
+        for i in range(2):
+            self.assertEqual(self.client.get('/api/private_whoami/').status_code, 401)
+
+        admin = User.objects.get(username='alice')
+        admin.is_superuser = True
+        admin.save()
+        self.client.force_login(admin)
+        self.assertEqual(self.get_json('/api/admin_whoami/')['user'], 'alice')
+        # Demoted, the cached response isn't served anymore
+        admin.is_superuser = False
+        admin.save()
+        self.assertEqual(self.client.get('/api/admin_whoami/').status_code, 401)
+
+    def test_cached_response_answers_conditional_get(self):
+        response = self.client.get('/api/tagged/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # Served from the cache now
+        response = self.client.get('/api/tagged/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get('/api/tagged/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/tagged/', HTTP_IF_NONE_MATCH='"v0"')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class ThrottleTests(APITestCase):
+    def setUp(self):
+        super(ThrottleTests, self).setUp()
+        cache.clear()
+
+    def test_rate_limit(self):
+        self.get_json('/api/throttled/')
+        self.get_json('/api/throttled/')
+        response = self.client.get('/api/throttled/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.content)['error']['code'], 10009)
+        self.assertTrue(int(response['Retry-After']) > 0)
+
+    def hit(self, limit, now):
+        clock, throttle.time = throttle.time, type(str('Clock'), (), {'time': staticmethod(lambda: now)})
+        try:
+            return limit.hit('ip:test')
+        finally:
+            throttle.time = clock
+
+    def test_sliding_window_wait(self):
+        limit = SlidingWindow(10, 60)
+        start = 600 * 60
+        cache.set('%s:ip:test:%d' % (limit.key_prefix, 600 - 1), 10)
+        # Half way the previous window still weighs 5 requests.
+        for i in range(5):
+            self.assertEqual(self.hit(limit, start + 30), 0)
+        # Six seconds later it weighs 4, not only at the end of the window.
+        self.assertEqual(self.hit(limit, start + 30), 6)
+        self.assertEqual(self.hit(limit, start + 35), 1)
+        self.assertEqual(self.hit(limit, start + 36), 0)
+
+    def test_sliding_window_instances_agree(self):
+        first, second = SlidingWindow(10, 60), SlidingWindow(10, 60)
+        start = 600 * 60
+        cache.set('%s:ip:test:%d' % (first.key_prefix, 600 - 1), 10)
+        for i in range(5):
+            self.hit(first, start + 30)
+        self.assertEqual(self.hit(first, start + 30), 6)
+        self.assertEqual(self.hit(second, start + 30), 6)
+        # The local block of the refusing instance ends with the shared one.
+        self.assertEqual(self.hit(first, start + 36), 0)
+        self.assertEqual(self.hit(second, start + 42), 0)
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class BulkCreateTests(APITestCase):
+    def test_bulk_create(self):
+        result = self.send_json('post', '/api/bulk/', [{'title': 'a'}, {'sequence': 1}, {'title': 'b'}])
+        self.assertEqual(result['info'], {'created': 2, 'failed': 1})
+        self.assertEqual([sorted(item) for item in result['data']], [['data'], ['error'], ['data']])
+        self.assertEqual(SampleModel.objects.filter(title__in=['a', 'b']).count(), 2)
+
+    def test_object_handler_refuses_lists(self):
+        self.send_json('post', '/api/bulk/1/', [{'title': 'a'}], status=400)
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class BulkUpdateTests(APITestCase):
+    def titles(self):
+        return list(SampleModel.objects.order_by('sequence').values_list('title', flat=True))
+
+    def test_update_by_ids_and_filter(self):
+        ids = list(SampleModel.objects.order_by('sequence').values_list('id', flat=True))
+        result = self.send_json('patch', '/api/set/?ids=%d,%d' % (ids[0], ids[1]), {'title': 'x'})
+        self.assertEqual(result, {'updated': 2})
+        result = self.send_json('patch', '/api/set/?sequence=4', {'title': 'y'})
+        self.assertEqual(result, {'updated': 1})
+        self.assertEqual(self.titles(), ['x', 'x', 't2', 't3', 'y'])
+
+    def test_bad_selection_is_400(self):
+        self.send_json('patch', '/api/set/?ids=abc', {'title': 'x'}, status=400)
+        self.send_json('patch', '/api/set/?sequence=abc', {'title': 'x'}, status=400)
+        self.assertEqual(self.client.delete('/api/set/?ids=1,abc').status_code, 400)
+        response = self.client.patch('/api/set/?sequence=1', 'title=x', content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 400)
+        self.send_json('patch', '/api/set/?sequence=1', ['title'], status=400)
+        response = self.client.patch('/api/set/?sequence=1', '{"title": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(SampleModel.objects.count(), 5)
+
+    def test_only_viewables_are_changed(self):
+        result = self.send_json('patch', '/api/private_set/?sequence=0,1,2,3', {'title': 'x'})
+        self.assertEqual(result, {'updated': 2})
+        response = self.client.delete('/api/private_set/?sequence=3,4')
+        self.assertEqual(json.loads(response.content), {'deleted': 0})
+        self.assertEqual(self.titles(), ['x', 'x', 't2', 't3', 't4'])
+
+    def test_patch_in_batch(self):
+        result = self.send_json('post', '/api/batch/', {'requests': [
+            {'method': 'PATCH', 'path': '/api/set/?sequence=2', 'params': {'title': 'z'}},
+            {'method': 'GET', 'path': '/api/set/', 'params': {'limit': 1}},
+        ]})
+        self.assertEqual(result['data'][0], {'status': 200, 'body': {'updated': 1}})
+        self.assertEqual(result['data'][1]['status'], 200)
+        self.assertEqual(len(result['data'][1]['body']['data']), 1)
+        self.assertEqual(self.titles()[2], 'z')
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class BatchTests(APITestCase):
+    def test_malformed_requests_are_400(self):
+        for sub in ({'path': 5}, {'method': None, 'path': '/api/set/'}, {'method': 'TRACE', 'path': '/api/set/'},
+                    {'path': '/api/set/', 'params': [1]}):
+            result = self.send_json('post', '/api/batch/', {'requests': [sub]}, status=400)
+            self.assertEqual(result['error']['code'], api_errors.ERROR_GENERAL_BAD_PARA_FORMAT)
+
+    def test_conditional_headers_are_not_passed_on(self):
+        cache.clear()
+        response = self.client.post('/api/batch/', json.dumps({'requests': [{'path': '/api/tagged/'}]}),
+                                    content_type='application/json', HTTP_IF_NONE_MATCH='"v1"')
+        self.assertEqual(json.loads(response.content)['data'], [{'status': 200, 'body': {'ok': True}}])
+
+    def test_concurrent_reads_keep_the_order(self):
+        # The in-memory test database only exists on this connection, lend it to the pool.
+        connection = connections['default']
+        connection.allow_thread_sharing = True
+        pool = ThreadPool(2, initializer=connections.__setitem__, initargs=('default', connection))
+        self.addCleanup(pool.terminate)
+        self.addCleanup(setattr, connection, 'allow_thread_sharing', False)
+        self.addCleanup(batch._pools.pop, 2, None)
+        batch._pools[2] = pool
+
+        result = self.send_json('post', '/api/concurrent_batch/', {'requests': [
+            {'path': '/api/set/', 'params': {'sequence': 1}},
+            {'path': '/api/set/?sequence=2'},
+            {'method': 'PATCH', 'path': '/api/set/?sequence=3', 'params': {'title': 'z'}},
+            {'path': '/api/set/', 'params': {'sequence': 3}},
+            {'path': '/api/missing/'},
+        ]})
+        statuses = [sub['status'] for sub in result['data']]
+        self.assertEqual(statuses, [200, 200, 200, 200, 404])
+        titles = [[row['title'] for row in sub['body']['data']] for sub in result['data'][:2] + result['data'][3:4]]
+        self.assertEqual(titles, [['t1'], ['t2'], ['z']])
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class PageInfoTests(APITestCase):
+    def setUp(self):
+        super(PageInfoTests, self).setUp()
+        cache.clear()
+
+    def info(self, path='/api/paged/', **params):
+        return self.get_json(path, params)['info']
+
+    def test_has_more(self):
+        self.assertEqual(self.info(limit=2), {'has_more': True, 'total': 5})
+        self.assertEqual(self.info(limit=2, offset=3), {'has_more': False, 'total': 5})
+        self.assertEqual(self.info(limit=5), {'has_more': False, 'total': 5})
+
+    def test_empty_pages_are_refused(self):
+        for params in ({'limit': 0}, {'limit': -1}, {'offset': -1}):
+            self.get_json('/api/paged/', params, status=400)
+            self.get_json('/api/cursor/', params, status=400)
+
+    def test_approximate_total(self):
+        # No planner estimate on SQLite, the exact count is used
+        self.assertIsNone(estimate_count(SampleModel.objects.all()))
+        self.assertEqual(self.info('/api/approximate_paged/', limit=2), {'has_more': True, 'total': 5})
+
+    def test_total_is_cached_until_a_change(self):
+        self.assertEqual(self.info()['total'], 5)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.info()['total'], 5)
+
+        SampleModel.objects.create(title='t5', sequence=5)
+        self.assertEqual(self.info()['total'], 6)
+        SampleModel.objects.get(sequence=0).delete()
+        self.assertEqual(self.info()['total'], 5)
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class ValuesRowsTests(APITestCase):
+    def test_rows_match_to_json(self):
+        for params in ({}, {'detail': 'true'}, {'fields': 'name,app'}, {'fields': 'label', 'detail': 'true'},
+                       {'fields': 'content_type,codename', 'detail': 'true'}):
+            params['limit'] = 300
+            rows = self.get_json('/api/spec_values/', params)['data']
+            self.assertEqual(rows, self.get_json('/api/spec_objects/', params)['data'])
+            self.assertEqual(len(rows), Permission.objects.count())
+
+        row = self.get_json('/api/spec_values/', {'detail': 'true', 'limit': 1})['data'][0]
+        permission = Permission.objects.select_related('content_type').get(id=row['id'])
+        self.assertEqual(row, {
+            'id': permission.id, 'name': permission.name, 'app': permission.content_type.app_label,
+            'label': '%s: %s' % (permission.content_type.app_label, permission.name),
+            'codename': permission.codename, 'content_type': permission.content_type_id})
+
+
+class UpdateObjectTests(APITestCase):
+    def setUp(self):
+        super(UpdateObjectTests, self).setUp()
+        self.obj = SampleModel.objects.get(sequence=2)
+
+    def assertStored(self, result, fields=('id', 'title', 'created', 'sequence')):
+        stored = SampleModel.objects.get(id=self.obj.id)
+        self.assertEqual([getattr(result, field) for field in fields], [getattr(stored, field) for field in fields])
+
+    @skipUnless(supports_returning(connection), 'UPDATE ... RETURNING is not supported.')
+    def test_returning(self):
+        with self.assertNumQueries(1):
+            result = ObjectHandler().update_object(self.obj.id, {'title': 'a'})
+        self.assertEqual(result.title, 'a')
+        self.assertStored(result)
+
+    def test_read_after_update(self):
+        with self.assertNumQueries(2):
+            result = ReadBackHandler().update_object(self.obj.id, {'title': 'b', 'sequence': 7})
+        self.assertEqual((result.title, result.sequence), ('b', 7))
+        self.assertStored(result)
+
+    def test_read_after_update_with_select_related(self):
+        permission = Permission.objects.first()
+        with self.assertNumQueries(2):
+            result = PermissionHandler().update_object(permission.id, {'name': 'c'})
+        self.assertEqual(result.name, 'c')
+        self.assertEqual(result.content_type, Permission.objects.get(id=permission.id).content_type)
+        with self.assertNumQueries(0):
+            result.content_type
+
+    def test_update_read_fields(self):
+        for handler_class in (ObjectHandler, ReadBackHandler):
+            handler = type(str('ReadFields'), (handler_class, ), {'update_read_fields': ('title', )})()
+            result = handler.update_object(self.obj.id, {'title': handler_class.__name__})
+            self.assertEqual(result.get_deferred_fields(), {'created', 'sequence'})
+            self.assertStored(result, ('id', 'title'))
+
+    def test_missing_object(self):
+        for handler in (ObjectHandler(), ReadBackHandler()):
+            self.assertRaises(SampleModel.DoesNotExist, handler.update_object, 0, {'title': 'd'})
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests', REST_API_JSON_BACKEND='counting')
+class ParseBodyTests(APITestCase):
+    def setUp(self):
+        super(ParseBodyTests, self).setUp()
+        self.bodies = []
+        dumps, loads = json_codec.BACKENDS['json']
+
+        def counting_loads(body):
+            self.bodies.append(body)
+            return loads(body)
+        json_codec.BACKENDS['counting'] = (dumps, counting_loads)
+        self.addCleanup(json_codec.BACKENDS.pop, 'counting')
+
+    def test_post_body_is_decoded_once(self):
+        self.send_json('post', '/api/bulk/1/', {'title': 'a'})
+        self.assertEqual(len(self.bodies), 1)
+
+    def test_patch_body_is_decoded_once(self):
+        self.send_json('patch', '/api/set/?sequence=1', {'title': 'b'})
+        self.assertEqual(len(self.bodies), 1)
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class VersionTests(APITestCase):
+    def setUp(self):
+        super(VersionTests, self).setUp()
+        self.path = '/api/versioned/%d/' % SampleModel.objects.get(sequence=2).id
+
+    def update(self, title, **extra):
+        return self.client.post(self.path, json.dumps({'title': title}), content_type='application/json', **extra)
+
+    def test_etag_is_the_version(self):
+        response = self.client.get(self.path)
+        self.assertEqual(response['ETag'], '"2"')
+        self.assertEqual(self.client.get(self.path, HTTP_IF_NONE_MATCH='"2"').status_code, 304)
+
+        response = self.update('a', HTTP_IF_MATCH='"2"')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.client.get(self.path)['ETag'], '"3"')
+
+    def test_stale_version_conflicts(self):
+        self.assertEqual(self.update('a', HTTP_IF_MATCH='"2"').status_code, 200)
+        self.assertEqual(self.update('b', HTTP_IF_MATCH='"2"').status_code, 409)
+
+    def test_if_match_any(self):
+        response = self.update('a', HTTP_IF_MATCH='*')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(json.loads(response.content)['sequence'], 3)
+
+    def test_if_match_list(self):
+        self.assertEqual(self.update('a', HTTP_IF_MATCH='"0", W/"2"').status_code, 200)
+        self.assertEqual(self.update('b', HTTP_IF_MATCH='"1","3"').status_code, 200)
+        self.assertEqual(self.update('c', HTTP_IF_MATCH='"3", "5"').status_code, 409)
+        self.assertEqual(self.update('d', HTTP_IF_MATCH='"3", x').status_code, 400)
+        self.assertEqual(SampleModel.objects.get(title='b').sequence, 4)
+
+
+@override_settings(ROOT_URLCONF='sample_app.tests')
+class TrustedPayloadTests(APITestCase):
+    def test_same_output_as_construct(self):
+        for params in ({}, {'model': 1}):
+            trusted = self.client.get('/api/trusted/', params)
+            untrusted = self.client.get('/api/untrusted/', params)
+            self.assertEqual(trusted.status_code, 200, trusted.content)
+            self.assertEqual(trusted.content, untrusted.content)
+        payload = json.loads(trusted.content)
+        self.assertEqual(sorted(payload['object']), ['created', 'id', 'title'])
+        self.assertEqual([obj['title'] for obj in payload['objects']], ['t0', 't1', 't2'])
+
+
+@override_settings(ROOT_URLCONF='api_example.urls')
+class SchemaTests(TestCase):
+    def setUp(self):
+        schema._content = None
+        self.addCleanup(setattr, schema, '_content', None)
+
+    def parameters(self, operation):
+        return dict((parameter['name'], (parameter['in'], parameter['required'], parameter['schema']))
+                    for parameter in operation['parameters'])
+
+    def test_sample_handlers(self):
+        paths = schema.generate_schema()['paths']
+        self.assertEqual(sorted(paths), ['/api/sample/', '/api/sample_model/', '/api/sample_model/{object_id}/'])
+        self.assertEqual(sorted(paths['/api/sample/']), ['get'])
+        self.assertEqual(sorted(paths['/api/sample_model/']), ['get', 'post'])
+        self.assertEqual(sorted(paths['/api/sample_model/{object_id}/']), ['get', 'post'])
+
+        read = self.parameters(paths['/api/sample_model/']['get'])
+        self.assertEqual(sorted(read), ['detail', 'limit', 'offset', 'order_by'])
+        self.assertEqual(read['limit'], ('query', False, {'type': 'integer', 'minimum': 1}))
+        self.assertEqual(self.parameters(paths['/api/sample/']['get'])['title'], ('query', False, {'type': 'string'}))
+
+        create = paths['/api/sample_model/']['post']['requestBody']['content']['application/json']['schema']
+        self.assertEqual(create['required'], ['title'])
+        self.assertEqual(sorted(create['properties']), ['sequence', 'title'])
+
+        update = paths['/api/sample_model/{object_id}/']['post']
+        self.assertEqual(self.parameters(update), {'object_id': ('path', True, {'type': 'string'})})
+        properties = update['requestBody']['content']['application/json']['schema']['properties']
+        self.assertEqual(properties['sequence'], {'type': 'integer'})
+
+    def test_view_serves_the_generated_schema(self):
+        response = self.client.get('/api/schema/')
+        self.assertEqual(json.loads(response.content), json.loads(json.dumps(schema.generate_schema())))
+
+    def test_view_serves_the_schema_file(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        content = b'{"openapi": "3.0.0",\n "paths": {}}'
+        with os.fdopen(handle, 'wb') as schema_file:
+            schema_file.write(content)
+        with self.settings(REST_API_SCHEMA_FILE=path):
+            self.assertEqual(self.client.get('/api/schema/').content, content)
+
+
+class ErrorResponseTests(TestCase):
+    def test_changed_message_is_not_stale(self):
+        code = api_errors.ERROR_GENERAL_NOT_FOUND
+        message = api_errors.API_ERRORS[code]
+        self.assertEqual(json.loads(make_error_response(code).content)['error']['message'], message)
+        try:
+            api_errors.API_ERRORS[code] = 'Gone fishing.'
+            self.assertEqual(json.loads(make_error_response(code).content)['error']['message'], 'Gone fishing.')
+        finally:
+            api_errors.API_ERRORS[code] = message
+        self.assertEqual(make_error_response(code).status_code, 404)
@@ -0,0 +1,160 @@
+import urllib
+from multiprocessing.pool import ThreadPool
+
+from django.db import connections
+from django.core.urlresolvers import resolve, Resolver404
+from django.http import Http404, HttpRequest, QueryDict
+
+from rest_api import json_codec
+from rest_api import errors as api_errors
+from rest_api.errors import GlobalAPIException
+from rest_api.handler import BaseHandler
+from rest_api.resources import BaseResource
+
+_pools = {}
+
+# Preconditions of the batch request, not of its sub-requests.
+CONDITIONAL_HEADERS = ('HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+                       'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE')
+
+
+def get_pool(size):
+    if size not in _pools:
+        _pools[size] = ThreadPool(size)
+    return _pools[size]
+
+
+def make_sub_request(request, method, path, params=None, query=''):
+    """
+    Builds a request for `path` which shares the user, session
+    and headers of `request`. GET and DELETE params go into the
+    query string, POST and PATCH params are sent as a JSON body.
+    `query` is an encoded query string, put before the GET params.
+    """
+    params = params or {}
+
+    sub_request = HttpRequest()
+    sub_request.method = method
+    sub_request.path = sub_request.path_info = path
+    sub_request.META = dict((key, value) for key, value in request.META.iteritems()
+                            if key not in CONDITIONAL_HEADERS)
+    sub_request.META['REQUEST_METHOD'] = method
+    sub_request.META['CONTENT_TYPE'] = ''
+    sub_request.META.pop('CONTENT_LENGTH', None)
+    sub_request.user = request.user
+    sub_request.session = request.session
+    sub_request._body = ''
+
+    if method in ('POST', 'PATCH'):
+        body = json_codec.dumps(params)
+        sub_request._body = body.encode('utf-8') if isinstance(body, unicode) else body
+        sub_request.META['CONTENT_TYPE'] = 'application/json'
+    elif params:
+        encoded = urllib.urlencode([(k, unicode(v).encode('utf-8')) for k, v in params.iteritems()])
+        query = '%s&%s' % (query, encoded) if query else encoded
+    sub_request.META['QUERY_STRING'] = query
+    sub_request.GET = QueryDict(query)
+
+    return sub_request
+
+
+def dispatch(request, sub):
+    """ Runs one sub-request through its `BaseResource`, returns {status, body}. """
+    method = sub.get('method', 'GET').upper()
+    path, _, query = sub['path'].partition('?')
+    try:
+        match = resolve(path)
+    except Resolver404:
+        match = None
+
+    if match is None or not isinstance(match.func, BaseResource):
+        return {'status': 404, 'body': None}
+
+    if isinstance(match.func.handler, BatchHandler):
+        return {'status': 400, 'body': None}
+
+    try:
+        response = match.func(make_sub_request(request, method, path, sub.get('params'), query),
+                              *match.args, **match.kwargs)
+    except Http404:
+        return {'status': 404, 'body': None}
+
+    if response.streaming:
+        content = ''.join(response.streaming_content)
+    else:
+        content = response.content
+
+    try:
+        body = json_codec.loads(content) if content else None
+    except ValueError:
+        body = content
+
+    return {'status': response.status_code, 'body': body}
+
+
+def dispatch_in_thread(args):
+    try:
+        return dispatch(*args)
+    finally:
+        # Each worker thread gets its own connections.
+        connections.close_all()
+
+
+# ============== Batch Handler =============
+class BatchHandler(BaseHandler):
+    """
+    This handler runs many api calls in one http round trip.
+    POST {"requests": [{"method": "GET", "path": "/api/x/", "params": {...}}, ...]}
+    and get a list of {"status": ..., "body": ...} in the same order.
+    POST and PATCH params are the JSON body, the path may have a query
+    string, e.g. {"method": "PATCH", "path": "/api/x/?ids=1,2", "params": {...}}.
+
+    Every sub-request goes through its own resource (authentication,
+    process_request, handler and emitter) with the user of the batch.
+    Requests are run in order. With `concurrent_reads` > 0, consecutive
+    GET requests are run together on a thread pool of that size.
+    """
+    allowed_methods = ('POST', )
+    create_kwargs = ('requests', )
+    required_fields = ('requests', )
+    create_auth_exempt = True
+
+    # max_requests - the maximum number of sub-requests in a batch
+    # concurrent_reads - thread pool size for GET sub-requests, 0 runs them one by one
+    max_requests = 20
+    concurrent_reads = 0
+
+    def create_validate(self, query_dict, **kwargs):
+        subs = query_dict.get('requests')
+        if type(subs) != list or not all(isinstance(sub, dict) for sub in subs):
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'requests' should be a list of requests.")
+        if len(subs) > self.max_requests:
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, 'At most %d requests in a batch.' % self.max_requests)
+        for sub in subs:
+            method = sub.get('method', 'GET')
+            if not isinstance(method, basestring) or method.upper() not in BaseResource.callmap:
+                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'method' should be one of %s." % ', '.join(sorted(BaseResource.callmap)))
+            if not isinstance(sub.get('path'), basestring):
+                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'path' of a request should be a string.")
+            if not isinstance(sub.get('params', {}), dict):
+                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'params' of a request should be an object.")
+
+    def create(self, request, **kwargs):
+        subs = request.CLEANED['requests']
+        if not self.concurrent_reads:
+            return [dispatch(request, sub) for sub in subs]
+
+        results = []
+        reads = []
+        for sub in subs + [None]:
+            if sub is not None and sub.get('method', 'GET').upper() == 'GET':
+                reads.append((request, sub))
+                continue
+
+            # Flush the pending reads before a write (or at the end)
+            if reads:
+                results.extend(get_pool(self.concurrent_reads).map(dispatch_in_thread, reads))
+                reads = []
+            if sub is not None:
+                results.append(dispatch(request, sub))
+        return results
@@ -2,9 +2,11 @@ from __future__ import generators
 
 import decimal, re, inspect
 import copy
-import json
 import time
+from collections import namedtuple
 from datetime import date
+from types import GeneratorType
+from uuid import UUID
 
 try:
     # yaml isn't standard with python.  It shouldn't be required if it
@@ -27,13 +29,15 @@ from django.db.models.query import QuerySet
 from django.db.models import Model, permalink
 from django.utils.xmlutils import SimplerXMLGenerator
 from django.utils.encoding import smart_unicode
+from django.utils.functional import Promise
 from django.core.urlresolvers import reverse, NoReverseMatch
-from django.core.serializers.json import DjangoJSONEncoder
 from django.http import HttpResponse
 from django.core import serializers
 from django.conf import settings
 
-from rest_api.piston.utils import HttpStatusCode, Mimer
+from rest_api import json_codec
+from rest_api.piston.handler import typemapper, handler_index, serialization_plans
+from rest_api.piston.utils import HttpStatusCode, Mimer, getargspec
 
 try:
     import cStringIO as StringIO
@@ -49,6 +53,18 @@ except ImportError:
 reverser = permalink
 ELIMINATE_INDENT = not settings.DEBUG
 
+# Default of `Emitter.construct`, stands for the emitter payload.
+PAYLOAD = object()
+
+# Cached plans are dropped when there are more, see `Emitter.model_plan`.
+MAX_PLANS = 1000
+
+# Steps of a compiled model serialization plan.
+PLAN_VALUE, PLAN_M2M, PLAN_NESTED, PLAN_METHOD, PLAN_ATTR = range(5)
+
+ModelPlan = namedtuple('ModelPlan', ['steps', 'class_attrs', 'uri_handler',
+                                     'get_api_url', 'get_absolute_uri'])
+
 class Emitter(object):
     """
     Super emitter. All other emitters should subclass
@@ -90,12 +106,14 @@ class Emitter(object):
 
         return ret
 
-    def construct(self):
+    def construct(self, data=PAYLOAD):
         """
         Recursively serialize a lot of types, and
         in cases where it doesn't recognize the type,
         it will fall back to Django's `smart_unicode`.
 
+        Serializes the payload unless `data` is given.
+
         Returns `dict`.
         """
         def _any(thing, fields=None):
@@ -106,7 +124,7 @@ class Emitter(object):
 
             if isinstance(thing, QuerySet):
                 ret = _qs(thing, fields)
-            elif isinstance(thing, (tuple, list, set)):
+            elif isinstance(thing, (tuple, list, set, GeneratorType)):
                 ret = _list(thing, fields)
             elif isinstance(thing, dict):
                 ret = _dict(thing, fields)
@@ -117,11 +135,11 @@ class Emitter(object):
             elif isinstance(thing, HttpResponse):
                 raise HttpStatusCode(thing)
             elif inspect.isfunction(thing):
-                if not inspect.getargspec(thing)[0]:
+                if not getargspec(thing)[0]:
                     ret = _any(thing())
             elif hasattr(thing, '__emittable__'):
                 f = thing.__emittable__
-                if inspect.ismethod(f) and len(inspect.getargspec(f)[0]) == 1:
+                if inspect.ismethod(f) and len(getargspec(f)[0]) == 1:
                     ret = _any(f())
             elif isinstance(thing, date): 
                 ret = time.mktime(thing.timetuple()) #Convert to unix time
@@ -132,152 +150,80 @@ class Emitter(object):
 
             return ret
 
-        def _fk(data, field):
-            """
-            Foreign keys.
-            """
-            return _any(getattr(data, field.name))
-
         def _related(data, fields=None):
             """
             Foreign keys.
             """
-            return [ _model(m, fields) for m in data.iterator() ]
-
-        def _m2m(data, field, fields=None):
-            """
-            Many to many (re-route to `_model`.)
-            """
-            return [ _model(m, fields) for m in getattr(data, field.name).iterator() ]
+            # .all() (not .iterator()) so prefetched rows are used
+            return [ _model(m, fields) for m in data.all() ]
 
         def _model(data, fields=None):
             """
             Models. Will respect the `fields` and/or
             `exclude` on the handler (see `typemapper`.)
+            The introspection is done once per model by
+            `model_plan`, here we only apply it.
             """
             ret = { }
-            handler = self.in_typemapper(type(data), self.anonymous)
-            get_absolute_uri = False
-
-            if handler or fields:
-                v = lambda f: getattr(data, f.attname)
-
-                if handler:
-                    fields = getattr(handler, 'fields')    
-                
-                if not fields or hasattr(handler, 'fields'):
-                    """
-                    Fields was not specified, try to find teh correct
-                    version in the typemapper we were sent.
-                    """
-                    mapped = self.in_typemapper(type(data), self.anonymous)
-                    get_fields = set(mapped.fields)
-                    exclude_fields = set(mapped.exclude).difference(get_fields)
-
-                    if 'absolute_uri' in get_fields:
-                        get_absolute_uri = True
-
-                    if not get_fields:
-                        get_fields = set([ f.attname.replace("_id", "", 1)
-                            for f in data._meta.fields + data._meta.virtual_fields])
-                    
-                    if hasattr(mapped, 'extra_fields'):
-                        get_fields.update(mapped.extra_fields)
-
-                    # sets can be negated.
-                    for exclude in exclude_fields:
-                        if isinstance(exclude, basestring):
-                            get_fields.discard(exclude)
-
-                        elif isinstance(exclude, re._pattern_type):
-                            for field in get_fields.copy():
-                                if exclude.match(field):
-                                    get_fields.discard(field)
+            plan = self.model_plan(type(data), fields)
 
-                else:
-                    get_fields = set(fields)
+            for kind, name, extra in plan.steps:
+                if kind == PLAN_VALUE:
+                    ret[name] = _any(getattr(data, name))
 
-                met_fields = self.method_fields(handler, get_fields)
+                elif kind == PLAN_M2M:
+                    # Many to many (re-route to `_model`.)
+                    ret[name] = [ _model(m) for m in getattr(data, name).all() ]
 
-                for f in data._meta.local_fields + data._meta.virtual_fields:
-                    if f.serialize and not any([ p in met_fields for p in [ f.attname, f.name ]]):
-                        if not f.rel:
-                            if f.attname in get_fields:
-                                ret[f.attname] = _any(v(f))
-                                get_fields.remove(f.attname)
-                        else:
-                            if f.attname[:-3] in get_fields:
-                                ret[f.name] = _fk(data, f)
-                                get_fields.remove(f.name)
-
-                for mf in data._meta.many_to_many:
-                    if mf.serialize and mf.attname not in met_fields:
-                        if mf.attname in get_fields:
-                            ret[mf.name] = _m2m(data, mf)
-                            get_fields.remove(mf.name)
-
-                # try to get the remainder of fields
-                for maybe_field in get_fields:
-                    if isinstance(maybe_field, (list, tuple)):
-                        model, fields = maybe_field
-                        inst = getattr(data, model, None)
-
-                        if inst:
-                            if hasattr(inst, 'all'):
-                                ret[model] = _related(inst, fields)
-                            elif callable(inst):
-                                if len(inspect.getargspec(inst)[0]) == 1:
-                                    ret[model] = _any(inst(), fields)
-                            else:
-                                ret[model] = _model(inst, fields)
-
-                    elif maybe_field in met_fields:
-                        # Overriding normal field which has a "resource method"
-                        # so you can alter the contents of certain fields without
-                        # using different names.
-                        ret[maybe_field] = _any(met_fields[maybe_field](data))
+                elif kind == PLAN_NESTED:
+                    inst = getattr(data, name, None)
 
-                    else:
-                        maybe = getattr(data, maybe_field, None)
-                        if maybe is not None:
-                            if callable(maybe):
-                                if len(inspect.getargspec(maybe)[0]) <= 1:
-                                    ret[maybe_field] = _any(maybe())
-                            else:
-                                ret[maybe_field] = _any(maybe)
+                    if inst:
+                        if hasattr(inst, 'all'):
+                            ret[name] = _related(inst, extra)
+                        elif callable(inst):
+                            if len(getargspec(inst)[0]) == 1:
+                                ret[name] = _any(inst(), extra)
                         else:
-                            handler_f = getattr(handler or self.handler, maybe_field, None)
+                            ret[name] = _model(inst, extra)
 
-                            if handler_f:
-                                ret[maybe_field] = _any(handler_f(data))
-
-            else:
-                for f in data._meta.fields:
-                    ret[f.attname] = _any(getattr(data, f.attname))
+                elif kind == PLAN_METHOD:
+                    # Overriding normal field which has a "resource method"
+                    # so you can alter the contents of certain fields without
+                    # using different names.
+                    ret[name] = _any(extra(data))
 
-                fields = dir(data.__class__) + ret.keys()
-                add_ons = [k for k in dir(data) if k not in fields]
+                else:
+                    maybe = getattr(data, name, None)
+                    if maybe is not None:
+                        if callable(maybe):
+                            if len(getargspec(maybe)[0]) <= 1:
+                                ret[name] = _any(maybe())
+                        else:
+                            ret[name] = _any(maybe)
+                    elif extra:
+                        ret[name] = _any(extra(data))
 
-                for k in add_ons:
-                    ret[k] = _any(getattr(data, k))
+            if plan.class_attrs is not None:
+                for k in dir(data):
+                    if k not in plan.class_attrs:
+                        ret[k] = _any(getattr(data, k))
 
             # resouce uri
-            if self.in_typemapper(type(data), self.anonymous):
-                handler = self.in_typemapper(type(data), self.anonymous)
-                if hasattr(handler, 'resource_uri'):
-                    url_id, fields = handler.resource_uri(data)
+            if plan.uri_handler:
+                url_id, fields = plan.uri_handler.resource_uri(data)
 
-                    try:
-                        ret['resource_uri'] = reverser( lambda: (url_id, fields) )()
-                    except NoReverseMatch, e:
-                        pass
+                try:
+                    ret['resource_uri'] = reverser( lambda: (url_id, fields) )()
+                except NoReverseMatch, e:
+                    pass
 
-            if hasattr(data, 'get_api_url') and 'resource_uri' not in ret:
+            if plan.get_api_url and 'resource_uri' not in ret:
                 try: ret['resource_uri'] = data.get_api_url()
                 except: pass
 
             # absolute uri
-            if hasattr(data, 'get_absolute_url') and get_absolute_uri:
+            if plan.get_absolute_uri:
                 try: ret['absolute_uri'] = data.get_absolute_url()
                 except: pass
 
@@ -302,9 +248,129 @@ class Emitter(object):
             return dict([ (k, _any(v, fields)) for k, v in data.iteritems() ])
 
         # Kickstart the seralizin'.
-        return _any(self.data, self.fields)
+        if data is PAYLOAD:
+            data = self.data
+
+        return _any(data, self.fields)
+
+    def model_plan(self, model, fields=None):
+        """
+        Returns the serialization plan for `model`. Plans are
+        cached per (model, handler, fields, anonymous) and the
+        cache is reset whenever a handler gets registered or
+        holds more than `MAX_PLANS` plans.
+        """
+        try:
+            # The order of `fields` doesn't change the plan
+            key = (model, self.handler, fields and frozenset(fields),
+                   self.anonymous, id(self.typemapper))
+            plan = serialization_plans.get(key)
+        except TypeError:
+            # Unhashable `fields`, don't cache.
+            return self.compile_plan(model, fields)
+
+        if plan is None:
+            if len(serialization_plans) >= MAX_PLANS:
+                serialization_plans.clear()
+            plan = serialization_plans[key] = self.compile_plan(model, fields)
+
+        return plan
+
+    def compile_plan(self, model, fields=None):
+        """
+        Does all the model and handler introspection needed
+        to serialize instances of `model`, returns a `ModelPlan`.
+        """
+        steps = [ ]
+        class_attrs = None
+        get_absolute_uri = False
+        handler = self.in_typemapper(model, self.anonymous)
+
+        if handler or fields:
+            if handler:
+                fields = getattr(handler, 'fields')
+
+            if not fields or hasattr(handler, 'fields'):
+                """
+                Fields was not specified, try to find teh correct
+                version in the typemapper we were sent.
+                """
+                get_fields = set(handler.fields)
+                exclude_fields = set(handler.exclude).difference(get_fields)
+
+                if 'absolute_uri' in get_fields:
+                    get_absolute_uri = True
+
+                if not get_fields:
+                    get_fields = set([ f.attname.replace("_id", "", 1)
+                        for f in model._meta.fields + model._meta.virtual_fields])
+
+                if hasattr(handler, 'extra_fields'):
+                    get_fields.update(handler.extra_fields)
+
+                # sets can be negated.
+                for exclude in exclude_fields:
+                    if isinstance(exclude, basestring):
+                        get_fields.discard(exclude)
+
+                    elif isinstance(exclude, re._pattern_type):
+                        for field in get_fields.copy():
+                            if exclude.match(field):
+                                get_fields.discard(field)
+
+            else:
+                get_fields = set(fields)
+
+            met_fields = self.method_fields(handler, get_fields)
+
+            for f in model._meta.local_fields + model._meta.virtual_fields:
+                if f.serialize and not any([ p in met_fields for p in [ f.attname, f.name ]]):
+                    if not f.rel:
+                        if f.attname in get_fields:
+                            steps.append((PLAN_VALUE, f.attname, None))
+                            get_fields.remove(f.attname)
+                    else:
+                        if f.attname[:-3] in get_fields:
+                            steps.append((PLAN_VALUE, f.name, None))
+                            get_fields.remove(f.name)
+
+            for mf in model._meta.many_to_many:
+                if mf.serialize and mf.attname not in met_fields:
+                    if mf.attname in get_fields:
+                        steps.append((PLAN_M2M, mf.name, None))
+                        get_fields.remove(mf.name)
+
+            # try to get the remainder of fields
+            for maybe_field in get_fields:
+                if isinstance(maybe_field, (list, tuple)):
+                    name, nested_fields = maybe_field
+                    steps.append((PLAN_NESTED, name, nested_fields))
+
+                elif maybe_field in met_fields:
+                    steps.append((PLAN_METHOD, maybe_field, met_fields[maybe_field]))
+
+                else:
+                    handler_f = getattr(handler or self.handler, maybe_field, None)
+                    steps.append((PLAN_ATTR, maybe_field, handler_f))
+
+        else:
+            for f in model._meta.fields:
+                steps.append((PLAN_VALUE, f.attname, None))
+
+            class_attrs = set(dir(model))
+            class_attrs.update([ f.attname for f in model._meta.fields ])
+
+        return ModelPlan(
+            steps=tuple(steps),
+            class_attrs=class_attrs,
+            uri_handler=handler if hasattr(handler, 'resource_uri') else None,
+            get_api_url=hasattr(model, 'get_api_url'),
+            get_absolute_uri=get_absolute_uri and hasattr(model, 'get_absolute_url'))
 
     def in_typemapper(self, model, anonymous):
+        if self.typemapper is typemapper:
+            return handler_index.get((model, anonymous))
+
         for klass, (km, is_anon) in self.typemapper.iteritems():
             if model is km and is_anon is anonymous:
                 return klass
@@ -388,24 +454,109 @@ class XMLEmitter(Emitter):
 Emitter.register('xml', XMLEmitter, 'text/xml; charset=utf-8')
 Mimer.register(lambda *a: None, ('text/xml',))
 
+class UntrustedValue(TypeError):
+    """
+    A value of a trusted payload which only `Emitter.construct`
+    knows how to serialize (models, querysets, generators...)
+    """
+
+def trusted_default(thing):
+    """
+    Encoder `default` for trusted payloads, converts the few
+    non JSON types the way `Emitter.construct` does.
+    """
+    if isinstance(thing, decimal.Decimal):
+        return str(thing)
+    elif isinstance(thing, date):
+        return time.mktime(thing.timetuple())
+    elif isinstance(thing, (Promise, UUID)):
+        return unicode(thing)
+    raise UntrustedValue(type(thing).__name__)
+
+class TrustedPayload(object):
+    """
+    Returned by `JSONEmitter.construct` for handlers with
+    `trusted_payload`, the payload is encoded as it is.
+    """
+    def __init__(self, data):
+        self.data = data
+
 class JSONEmitter(Emitter):
     """
     JSON emitter, understands timestamps.
     """
     def render(self, request):
+        return self.encode(request, self.construct())
+
+    def construct(self, data=PAYLOAD):
+        if data is PAYLOAD and getattr(self.handler, 'trusted_payload', False):
+            # Plain dicts / lists, leave them to the encoder
+            return TrustedPayload(self.data)
+        return super(JSONEmitter, self).construct(data)
+
+    def encode(self, request, data):
+        """ Serializes the constructed `data`. """
         cb = request.GET.get('callback')
-        if ELIMINATE_INDENT:
-            seria = json.dumps(self.construct(), cls=DjangoJSONEncoder, ensure_ascii=False)
-        else:
-            seria = json.dumps(self.construct(), cls=DjangoJSONEncoder, ensure_ascii=False, indent=3)
+        indent = None if ELIMINATE_INDENT else 3
+        seria = None
+        if isinstance(data, TrustedPayload):
+            try:
+                seria = json_codec.dumps(data.data, indent, default=trusted_default)
+            except (TypeError, UnicodeDecodeError):
+                # Not so plain after all (or non ascii byte strings), take the long way
+                data = super(JSONEmitter, self).construct(data.data)
+        if seria is None:
+            seria = json_codec.dumps(data, indent)
         # Callback
         if cb:
             return '%s(%s)' % (cb, seria)
 
         return seria
 
+    def stream_render(self, request):
+        """
+        Writes the payload incrementally. Lists, generators
+        and querysets, also when they sit inside a dict such
+        as the `REST_API_WITH_WRAPPER` envelope, are encoded
+        one element at a time so the whole response never
+        lives in memory. Output is never indented.
+        """
+        cb = request.GET.get('callback')
+        if cb:
+            yield '%s(' % cb
+
+        for chunk in self._stream(self.data):
+            yield chunk
+
+        if cb:
+            yield ')'
+
+    def _encode(self, data):
+        return json_codec.dumps(data)
+
+    def _stream(self, thing):
+        if isinstance(thing, dict):
+            yield '{'
+            for idx, (key, value) in enumerate(thing.iteritems()):
+                yield '%s%s: ' % (', ' if idx else '', self._encode(smart_unicode(key)))
+                for chunk in self._stream(value):
+                    yield chunk
+            yield '}'
+
+        elif isinstance(thing, (tuple, list, set, GeneratorType, QuerySet)):
+            if isinstance(thing, QuerySet):
+                thing = thing.iterator()
+
+            yield '['
+            for idx, item in enumerate(thing):
+                yield '%s%s' % (', ' if idx else '', self._encode(self.construct(item)))
+            yield ']'
+
+        else:
+            yield self._encode(self.construct(thing))
+
 Emitter.register('json', JSONEmitter, 'application/json; charset=utf-8')
-Mimer.register(json.loads, ('application/json',))
+Mimer.register(json_codec.loads, ('application/json',))
 
 class YAMLEmitter(Emitter):
     """
@@ -16,6 +16,8 @@ ERROR_GENERAL_TARGET_NOT_FOUND          = 10005 #: Target object not found
 ERROR_GENERAL_BAD_ID_FORMAT             = 10006 #: Bad ID format
 ERROR_GENERAL_INVALID_OPERATION         = 10007 #: Not effective operation (already done or not allowed)
 ERROR_GENERAL_BAD_PARA_FORMAT           = 10008 #: Some requested parameters are not valid
+ERROR_GENERAL_THROTTLED                 = 10009 #: Too many requests
+ERROR_GENERAL_CONFLICT                  = 10010 #: The object was changed since the client read it
 ERROR_AUTH_NOT_AUTHENTICATED            = 10100 #: Requested authenticated resource anonymously
 ERROR_AUTH_BAD_CREDENTIALS              = 10101 #: Bad username/password combo
 ERROR_AUTH_NOT_AUTHORIZED               = 10102 #: Not authorized resource access
@@ -44,6 +46,8 @@ API_ERRORS = {
     ERROR_GENERAL_BAD_ID_FORMAT : "Bad ID format.",
     ERROR_GENERAL_INVALID_OPERATION : "Not effective operation (already done or not allowed).",
     ERROR_GENERAL_BAD_PARA_FORMAT : "Some requested parameters are not valid.",
+    ERROR_GENERAL_THROTTLED : "Too many requests.",
+    ERROR_GENERAL_CONFLICT : "The object has been changed by another request.",
     ERROR_AUTH_NOT_AUTHENTICATED: "Authentication required.",
     ERROR_AUTH_BAD_CREDENTIALS: "Invalid username/password combination.",
     ERROR_AUTH_NOT_AUTHORIZED: "The request user is not authorized to access this resource.(token invalid)",
@@ -61,3 +65,30 @@ API_ERRORS = {
 }
 
 
+
+# HTTP status of the error codes, the others are 400 (Bad Request)
+ERROR_STATUS = {
+    ERROR_GENERAL_UNKNOWN_ERROR: 500,
+    ERROR_GENERAL_NOT_FOUND: 404,
+    ERROR_GENERAL_THROTTLED: 503,
+    ERROR_GENERAL_CONFLICT: 409,
+    ERROR_AUTH_NOT_AUTHENTICATED: 401,
+    ERROR_AUTH_BAD_CREDENTIALS: 401,
+    ERROR_AUTH_NOT_AUTHORIZED: 401,
+}
+
+
+def error_content(code, debug=None):
+    """ Returns the {'code', 'message'[, 'debug']} dict describing error `code`. """
+    try:
+        error_code, error_message = code, API_ERRORS[code]
+    except KeyError:
+        error_code, error_message = ERROR_GENERAL_UNKNOWN_ERROR, API_ERRORS[ERROR_GENERAL_UNKNOWN_ERROR]
+
+    content = {
+        'code': error_code,
+        'message': error_message,
+    }
+    if debug:
+        content['debug'] = debug
+    return content
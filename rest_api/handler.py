@@ -1,7 +1,103 @@
+import hashlib
 import json
+from itertools import islice
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections, transaction
+from django.db.models import F, Q, prefetch_related_objects
+from django.db.models.sql import UpdateQuery
 
 from piston.handler import BaseHandler as PistonBaseHandler
-from rest_api.utils import process_latlon, process_integer
+from rest_api.utils import process_latlon, process_integer, encode_cursor, wrap_info, unique, compile_schema,\
+    make_coercer
+from rest_api import response_cache
+from rest_api.serializers import get_serializer
+from rest_api import errors as api_errors
+from rest_api.errors import GlobalAPIException
+
+
+def infer_related(model, fields, select, prefetch, prefix=''):
+    """
+    Appends the relations of `model` named in piston style `fields`
+    (names or (name, sub_fields) tuples) to the `select` (single
+    valued) and `prefetch` (multi valued) lookup lists.
+    """
+    for field in fields:
+        name, sub_fields = field if isinstance(field, (list, tuple)) else (field, ())
+        try:
+            model_field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if not model_field.is_relation or not model_field.related_model:
+            continue
+
+        lookup = prefix + name
+        if model_field.many_to_many or model_field.one_to_many:
+            prefetch.append(lookup)
+            infer_related(model_field.related_model, sub_fields, prefetch, prefetch, lookup + '__')
+        else:
+            select.append(lookup)
+            infer_related(model_field.related_model, sub_fields, select, prefetch, lookup + '__')
+
+
+def supports_returning(connection):
+    """ Whether the database can run UPDATE ... RETURNING. """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+def update_returning(query_set, values, field_names=()):
+    """
+    Runs query_set.update(**values) as one UPDATE ... RETURNING and returns
+    the updated objects, loaded with `field_names` (default: all fields).
+    Returns None when the update can't be done in one statement.
+    """
+    model = query_set.model
+    connection = connections[query_set.db]
+    query = query_set.query.clone(UpdateQuery)
+    query.add_update_values(values)
+    if query.related_updates:
+        # Multi-table inheritance updates more than one table
+        return None
+
+    compiler = query.get_compiler(query_set.db)
+    sql, params = compiler.as_sql()
+    fields = [field for field in model._meta.concrete_fields
+              if not field_names or field.primary_key or field.name in field_names or field.attname in field_names]
+    columns = [field.get_col(model._meta.db_table) for field in fields]
+    converters = [connection.ops.get_db_converters(column) + column.get_db_converters(connection) for column in columns]
+
+    with connection.cursor() as cursor:
+        cursor.execute('%s RETURNING %s' % (sql, ', '.join(compiler.compile(column)[0] for column in columns)), params)
+        rows = cursor.fetchall()
+
+    attnames = [field.attname for field in fields]
+    objects = []
+    for row in rows:
+        row = list(row)
+        for idx, column in enumerate(columns):
+            for converter in converters[idx]:
+                row[idx] = converter(row[idx], column, connection, {})
+        objects.append(model.from_db(query_set.db, attnames, row))
+    return objects
+
+
+def estimate_count(query_set):
+    """ The planner's row estimate for `query_set` on PostgreSQL, None elsewhere. """
+    connection = connections[query_set.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = query_set.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
 
 # ============== Operation Handler =============
 class BaseHandler(PistonBaseHandler):
@@ -17,6 +113,7 @@ class BaseHandler(PistonBaseHandler):
     # form_fields - only the parameters in form_fields will be updated. (for update object)
     # update_instead_save - use update() method instead save() for object update. It might cause risk condition if it is set as "False".
     # True -> update, False -> save
+    # bulk_create_size, bulk_max_items - see BaseIndexHandler
     required_fields = ()
     create_kwargs = ()
     files_kwargs = ()
@@ -29,16 +126,44 @@ class BaseHandler(PistonBaseHandler):
     # allowed_filter - only the parameters in allowed_filter will be used as query params.
     # filter_opt - define several type of special query (see: notify/handlers.py).
     # para_mapping - used for mapping the read_kwargs to allowed_filter
+    # cursor_fields - ordering key(s) for keyset pagination, e.g. ('-created', 'id'). The last key should be unique.
+    # page_info - IndexHandler returns the page with info {"has_more": ...}, found by fetching one more row instead of a count().
+    # count_total - also put the "total" in info: 'exact' (a count() cached for total_cache_timeout seconds)
+    # or 'approximate' (the planner estimate on PostgreSQL, 'exact' elsewhere). Saving a query_model object refreshes it.
+    # sparse_fields - keys of to_json() a client may pick with "fields=a,b", see sparse_query.
+    # sparse_query - how BaseIndexHandler narrows the queryset for "fields":
+    #   None -> to_json(fields=...) and drop the other keys,
+    #   'only' -> also .only() the requested model fields (to_json must not touch the others),
+    #   'values' -> .values() rows as they are, the keys must be model fields and to_json is skipped.
+    # values_rows - IndexHandler reads .values() rows and shapes them by the json_spec of query_model
+    # (see rest_api.serializers), no model objects are created. sparse_query is not used then.
     required_fields_for_read = ()
     read_kwargs = ()
     allowed_filter = ()
     filter_opt = ()
     para_mapping = {}
+    cursor_fields = ()
+    page_info = False
+    count_total = None
+    total_cache_timeout = 60
+    sparse_fields = ()
+    sparse_query = None
+    values_rows = False
 
     # For DELETE:
     # delete_kwargs - lists the parameters that must be specified
     delete_kwargs = ()
 
+    # For PATCH:
+    # The JSON body holds the changes, only the parameters in form_fields are kept.
+    # IndexHandler updates (DELETE: deletes) the objects selected by "ids=1,2,3" and/or allowed_filter in the query string.
+
+    # For all methods:
+    # field_types - types of the parameters, converted by process_request before the *_validate methods,
+    # e.g. {'sequence': 'int', 'tags': 'list', 'status': STATUS_CHOICES}.
+    # Types: 'int', 'float', 'bool', 'list', 'timestamp', 'latlon' or a choices sequence.
+    field_types = {}
+
 
     # Settings:
     # query_model - model to query
@@ -46,6 +171,17 @@ class BaseHandler(PistonBaseHandler):
     # default_order - the default sorting order, which might be "-timestamp", "updated" and so on.
     # read_auth_exempt - if this parameter is True, then the GET request of this resource is authenticatation exempt
     # create_auth_exempt - if this parameter is True, then the POST request of this resource is authenticatation exempt
+    # stream_all - read(all=True) returns a generator over queryset.iterator(), use it with PISTON_STREAM_OUTPUT.
+    # prefetch_related is applied to every stream_chunk_size rows.
+    # cache_timeout - seconds to cache GET responses, None disables it. Saving or deleting a query_model object invalidates them.
+    # cache_vary_on - request headers which are part of the cache key, e.g. ('Accept-Language', )
+    # select_related, prefetch_related - relations of query_model the response needs, applied to the read queryset.
+    # detail_select_related, detail_prefetch_related - same, only for "detail=true" requests.
+    # Relations named in `fields` are added automatically.
+    # rate_limits - limits from rest_api.throttle checked before the request is processed, e.g. (SlidingWindow(100, 60), )
+    # etag, last_modified - optional cheap hooks (request, *args, **kwargs) for conditional GET, see below.
+    # trusted_payload - the handler returns plain dicts / lists (e.g. of to_json()), they skip the emitter's
+    # per value type checks and go straight to the JSON encoder. Models or querysets in them still work, slower.
     query_model = None
     about_privacy = False
     default_order = None
@@ -53,6 +189,21 @@ class BaseHandler(PistonBaseHandler):
     create_auth_exempt = False
     delete_auth_exempt = False
     superuser_only = False
+    stream_all = False
+    stream_chunk_size = 500
+    cache_timeout = None
+    cache_vary_on = ()
+    rate_limits = ()
+    trusted_payload = False
+    select_related = ()
+    prefetch_related = ()
+    detail_select_related = ()
+    detail_prefetch_related = ()
+
+    # Override with methods returning an ETag string or a datetime to
+    # answer "If-None-Match" / "If-Modified-Since" with 304 before `read`.
+    etag = None
+    last_modified = None
 
     def __init__(self):
         if not self.create_kwargs:
@@ -62,17 +213,54 @@ class BaseHandler(PistonBaseHandler):
         # We should implement GET, POST, DELETE authentication here.
         return
 
+    def request_schema(self):
+        """ Returns the compiled argument lists used by process_request, built once per handler class. """
+        schema = type(self).__dict__.get('_request_schema')
+        if schema is None:
+            schema = type(self)._request_schema = compile_schema(self)
+        return schema
+
     def map_para(self, query_dict):
         # Automatically strip Id from the end of input key
+        para_mapping = self.para_mapping
         for key in query_dict.keys():
-            if key in self.para_mapping.keys():
-                mapped_key = self.para_mapping[key]
-                query_dict[mapped_key] = query_dict[key]
+            if key in para_mapping:
+                query_dict[para_mapping[key]] = query_dict[key]
             elif key.endswith('_id'):
-                mapped_key = key[:-3]
-                query_dict[mapped_key] = query_dict[key]
+                query_dict[key[:-3]] = query_dict[key]
         return query_dict
 
+    def related_lookups(self, detail=False):
+        """
+        Returns the (select_related, prefetch_related) lookups for reading
+        `query_model`: the declared ones plus the relations named in `fields`.
+        Computed once per handler class.
+        """
+        lookups = type(self).__dict__.get('_related_lookups')
+        if lookups is None:
+            lookups = {}
+            inferred_select, inferred_prefetch = [], []
+            if self.query_model:
+                infer_related(self.query_model, self.fields, inferred_select, inferred_prefetch)
+            for is_detail in (False, True):
+                select = list(self.select_related) + inferred_select
+                prefetch = list(self.prefetch_related) + inferred_prefetch
+                if is_detail:
+                    select += self.detail_select_related
+                    prefetch += self.detail_prefetch_related
+                lookups[is_detail] = (tuple(unique(select)), tuple(unique(prefetch)))
+            type(self)._related_lookups = lookups
+        return lookups[bool(detail)]
+
+    def apply_related(self, query_set, detail=False):
+        """ Adds select_related/prefetch_related to `query_set` to avoid N+1 queries. """
+        select, prefetch = self.related_lookups(detail)
+        if select:
+            query_set = query_set.select_related(*select)
+        if prefetch:
+            query_set = query_set.prefetch_related(*prefetch)
+        return query_set
+
     def create_validate(self, query_dict, **kwargs):
         pass
 
@@ -88,6 +276,9 @@ class BaseHandler(PistonBaseHandler):
     def delete_validate(self, query_dict, **kwargs):
         pass
 
+    def update_validate(self, query_dict, **kwargs):
+        pass
+
     def delete(self, request, **kwargs):
         pass
 
@@ -102,6 +293,11 @@ class BaseIndexHandler(BaseHandler):
     """
     allowed_methods = ('POST', 'GET')
 
+    # bulk_create_size - accept a JSON array of objects and bulk_create them in batches of this size, 0 disables it.
+    # bulk_max_items - the maximum number of objects in a bulk create, or of ids in a bulk PATCH / DELETE
+    bulk_create_size = 0
+    bulk_max_items = 10000
+
     def read(self, request, **kwargs):
         """ Query """
         offset = request.CLEANED['offset']
@@ -126,7 +322,13 @@ class BaseIndexHandler(BaseHandler):
                     else:
                         query_args[key] = value
 
-        results = query_set.filter(**query_args)
+        results = self.apply_related(query_set.filter(**query_args), request.CLEANED['detail'])
+        if self.values_rows and not kwargs.get('raw'):
+            results = self.values_queryset(results, request.CLEANED.get('fields'), request.CLEANED['detail'])
+        elif request.CLEANED.get('fields'):
+            results = self.sparse_queryset(results, request.CLEANED['fields'], request.CLEANED['detail'])
+        if self.cursor_fields and not kwargs.get('all'):
+            return self.read_by_cursor(request, results, **kwargs)
         if request.CLEANED['order_by']:
             if type(request.CLEANED['order_by'])==list:
                 results = results.order_by(*request.CLEANED['order_by'])
@@ -135,10 +337,249 @@ class BaseIndexHandler(BaseHandler):
         elif self.default_order:
             results = results.order_by(self.default_order)
         if kwargs.get('all'):
-            return [r.to_json(request=request, detail=request.CLEANED['detail']) for r in results]
+            if self.stream_all:
+                return (self.row_to_json(request, r) for r in self.iterate(results))
+            return [self.row_to_json(request, r) for r in results]
         if kwargs.get('raw'):
             return [r for r in results[offset:endpoint]]
-        return [r.to_json(request=request, detail=request.CLEANED['detail']) for r in results[offset:endpoint]]
+        if not self.page_info:
+            return [self.row_to_json(request, r) for r in results[offset:endpoint]]
+
+        # Fetch one more row to know whether there is a next page
+        rows = list(results[offset:endpoint + 1])
+        info = {'has_more': len(rows) > endpoint - offset}
+        if self.count_total:
+            info['total'] = self.total_count(results)
+        return wrap_info([self.row_to_json(request, r) for r in rows[:endpoint - offset]], info)
+
+    def iterate(self, results):
+        """
+        Like `results.iterator()`, which ignores prefetch_related, but
+        prefetches the relations of every `stream_chunk_size` rows.
+        """
+        lookups = results._prefetch_related_lookups
+        if not lookups:
+            for row in results.iterator():
+                yield row
+            return
+
+        rows = results.prefetch_related(None).iterator()
+        while True:
+            chunk = list(islice(rows, self.stream_chunk_size))
+            if not chunk:
+                return
+            prefetch_related_objects(chunk, *lookups)
+            for row in chunk:
+                yield row
+
+    def total_count(self, results):
+        """ The (cached or approximate) number of rows of `results`, see count_total. """
+        results = results.order_by()
+        if self.count_total == 'approximate':
+            total = estimate_count(results)
+            if total is not None:
+                return total
+
+        cache = response_cache.get_cache()
+        generation = 0
+        if self.query_model in response_cache.WATCHED_MODELS:
+            generation = cache.get(response_cache.generation_key(self.query_model), 0)
+        key = '%s:count:%s:%s' % (response_cache.KEY_PREFIX, generation, hashlib.md5(repr(results.query.sql_with_params())).hexdigest())
+        total = cache.get(key)
+        if total is None:
+            total = results.count()
+            cache.set(key, total, self.total_cache_timeout)
+        return total
+
+    def sparse_queryset(self, results, fields, detail=False):
+        """ Narrows `results` to the requested `fields` as `sparse_query` says. """
+        if self.sparse_query not in ('only', 'values'):
+            return results
+        names = [key.lstrip('-') for key in self.cursor_fields]
+        if self.sparse_query == 'values':
+            return results.values(*unique(list(fields) + names))
+
+        # A relation can't be both deferred and joined by select_related
+        names.append(self.query_model._meta.pk.name)
+        names.extend(lookup.split('__')[0] for lookup in self.related_lookups(detail)[0])
+        for name in fields:
+            try:
+                model_field = self.query_model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if model_field.concrete and not model_field.many_to_many:
+                names.append(name)
+        return results.only(*unique(names))
+
+    def values_queryset(self, results, fields, detail=False):
+        """ The `.values()` of `results` which `row_to_json` serializes by the json_spec, see values_rows. """
+        names = get_serializer(self.query_model).lookups(detail, fields)
+        names += [key.lstrip('-') for key in self.cursor_fields]
+        return results.prefetch_related(None).values(*unique(names))
+
+    def row_to_json(self, request, row):
+        """ Serializes one row, only with the requested `fields` if any. """
+        fields = request.CLEANED.get('fields')
+        if self.values_rows and isinstance(row, dict):
+            row = get_serializer(self.query_model).from_values(row, request, request.CLEANED['detail'], fields)
+            if not fields:
+                return row
+        elif not fields:
+            return row.to_json(request=request, detail=request.CLEANED['detail'])
+        elif self.sparse_query != 'values':
+            row = row.to_json(request=request, detail=request.CLEANED['detail'], fields=fields)
+        return dict((name, row[name]) for name in fields if name in row)
+
+    def build_object(self, request, query_dict):
+        """ Makes the (unsaved) object for one item of a bulk create. """
+        return self.query_model(**dict((kwarg, query_dict[kwarg]) for kwarg in self.create_kwargs
+                                       if query_dict.get(kwarg) is not None))
+
+    def bulk_create(self, request, **kwargs):
+        """
+        Creates the valid items of a JSON array with bulk_create, in one
+        transaction. Returns a result per item, in order: {"data": ...}
+        or {"error": ...}. Primary keys of the created objects are only
+        known on backends which return them (PostgreSQL).
+        """
+        results = []
+        objects = []
+        for query_dict, error in request.BULK:
+            if error is None:
+                try:
+                    obj = self.build_object(request, query_dict)
+                    objects.append(obj)
+                    results.append({'data': obj})
+                    continue
+                except GlobalAPIException, e:
+                    error = api_errors.error_content(e.code, e.debug)
+            results.append({'error': error})
+
+        if objects:
+            with transaction.atomic():
+                self.query_model.objects.bulk_create(objects, batch_size=self.bulk_create_size)
+            # bulk_create sends no signals
+            if self.query_model in response_cache.WATCHED_MODELS:
+                response_cache.invalidate_model(self.query_model)
+
+        for result in results:
+            if 'data' in result:
+                result['data'] = result['data'].to_json(request=request, detail=True)
+        return wrap_info(results, {'created': len(objects), 'failed': len(results) - len(objects)})
+
+    def bulk_query_set(self, request):
+        """
+        Selects the objects of a bulk update / delete by "ids" and the
+        allowed_filter parameters of the query string, at least one is required.
+        Like `read`, only the viewables of the user with `about_privacy`.
+        """
+        query_args = {}
+        ids = request.GET.get('ids')
+        if ids:
+            ids = ids.split(',')
+            if len(ids) > self.bulk_max_items:
+                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, 'At most %d ids.' % self.bulk_max_items)
+            query_args['pk__in'] = self.clean_filter('ids', ids, self.query_model._meta.pk)
+        for key in self.allowed_filter:
+            value = request.GET.get(key)
+            if value is None:
+                continue
+            values = self.clean_filter(key, value.split(','))
+            if len(values) > 1:
+                query_args[key + '__in'] = values
+            else:
+                query_args[key] = values[0]
+
+        if not query_args:
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'ids' or a filter is missing in params.")
+        if self.about_privacy:
+            query_set = self.query_model.viewables(user=request.user)
+        else:
+            query_set = self.query_model.objects.all()
+        return query_set.filter(**query_args)
+
+    def clean_filter(self, name, values, model_field=None):
+        """
+        Converts the query string `values` of `name` by its `field_types`
+        entry or else by the model field of that name (if any).
+        """
+        field_type = self.field_types.get(name)
+        if field_type:
+            coerce = make_coercer(name, field_type)
+            return [coerce(value) for value in values]
+
+        if model_field is None:
+            try:
+                model_field = self.query_model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return values
+        try:
+            return [model_field.to_python(value) for value in values]
+        except (ValidationError, TypeError, ValueError):
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'%s' is not valid." % name)
+
+    def update(self, request, **kwargs):
+        """ PATCH, updates the selected objects with one UPDATE query. """
+        changed_fields = dict((key, value) for key, value in request.CLEANED.iteritems()
+                              if key in self.form_fields)
+        if not changed_fields:
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, 'Nothing to update.')
+
+        updated = self.bulk_query_set(request).update(**changed_fields)
+        # update() sends no signals
+        if updated and self.query_model in response_cache.WATCHED_MODELS:
+            response_cache.invalidate_model(self.query_model)
+        return {'updated': updated}
+
+    def delete(self, request, **kwargs):
+        """
+        DELETE, deletes the selected objects as a set. When delete
+        signals have receivers (e.g. `cache_timeout` watches the model),
+        Django loads every selected row to send them.
+        """
+        deleted, per_model = self.bulk_query_set(request).delete()
+        if deleted and self.query_model in response_cache.WATCHED_MODELS:
+            response_cache.invalidate_model(self.query_model)
+        return {'deleted': per_model.get(self.query_model._meta.label, 0)}
+
+    def cursor_filter(self, values):
+        """ Builds the range predicate selecting rows after the cursor values. """
+        query = None
+        for idx, key in enumerate(self.cursor_fields):
+            name = key.lstrip('-')
+            condition = Q(**{'%s__%s' % (name, 'lt' if key.startswith('-') else 'gt'): values[idx]})
+            for prev_key, prev_value in zip(self.cursor_fields[:idx], values[:idx]):
+                condition &= Q(**{prev_key.lstrip('-'): prev_value})
+            query = condition if query is None else query | condition
+        return query
+
+    def read_by_cursor(self, request, results, **kwargs):
+        """ Query a page by keyset, every page costs the same as the first one. """
+        offset = request.CLEANED['offset']
+        endpoint = request.CLEANED['endpoint']
+
+        results = collection = results.order_by(*self.cursor_fields)
+        if request.CLEANED.get('cursor'):
+            results = results.filter(self.cursor_filter(request.CLEANED['cursor']))
+
+        # Fetch one more row to know whether there is a next page
+        rows = list(results[offset:endpoint + 1])
+        next_cursor = None
+        if 0 < endpoint - offset < len(rows):
+            rows = rows[:endpoint - offset]
+            last = rows[-1]
+            if isinstance(last, dict):
+                next_cursor = encode_cursor([last[key.lstrip('-')] for key in self.cursor_fields])
+            else:
+                next_cursor = encode_cursor([getattr(last, key.lstrip('-')) for key in self.cursor_fields])
+
+        if kwargs.get('raw'):
+            return rows
+        response = [self.row_to_json(request, r) for r in rows]
+        info = {'next_cursor': next_cursor, 'has_more': next_cursor is not None}
+        if self.count_total:
+            info['total'] = self.total_count(collection)
+        return wrap_info(response, info)
 
 
 # ============== Object Handler =============
@@ -154,11 +595,36 @@ class BaseObjectHandler(BaseHandler):
     form_fields = ()
     update_instead_save = False
 
+    # With update_instead_save, the object isn't loaded before the update:
+    # update_returning - read the updated row back with UPDATE ... RETURNING when the database supports it
+    # (PostgreSQL, SQLite >= 3.35) and no select_related is needed, otherwise with one read after the update.
+    # update_read_fields - fields loaded by that read (.only()), default: all. to_json should only use them.
+    update_returning = True
+    update_read_fields = ()
+
+    # version_field - integer field for optimistic concurrency. An update needs the version the client read,
+    # in an "If-Match" header or a "version" parameter ("If-Match: *" updates any version). It runs as
+    # UPDATE ... WHERE version = n, which also increments the version, and a stale version is answered with 409.
+    # No lock is held. Unless the handler has its own etag hook, GET answers the version as ETag.
+    version_field = None
+
+    def __init__(self):
+        super(BaseObjectHandler, self).__init__()
+        if self.version_field and 'version' not in self.create_kwargs:
+            self.create_kwargs = tuple(self.create_kwargs) + ('version', )
+        if self.version_field and self.etag is None:
+            self.etag = self.version_etag
+
+    def version_etag(self, request, object_id, **kwargs):
+        """ The `etag` hook of handlers with a version_field, the version the If-Match of an update expects. """
+        version = self.query_model.objects.filter(id=object_id).values_list(self.version_field, flat=True).first()
+        return None if version is None else str(version)
+
     def read(self, request, object_id, **kwargs):
         if request.CLEANED.get('_obj'):
             result = request.CLEANED.get('_obj')
         else:
-            result = self.query_model.objects.get(id=object_id)
+            result = self.apply_related(self.query_model.objects.all(), request.CLEANED['detail']).get(id=object_id)
 
         if kwargs.get('raw'):
             return result
@@ -174,26 +640,110 @@ class BaseObjectHandler(BaseHandler):
         return
 
     def create(self, request, object_id, **kwargs):
-        changed_fields = {}
-        if request.CLEANED.get('_obj'):
-            result = request.CLEANED.get('_obj')
+        changed_fields = dict((key, value) for key, value in request.CLEANED.iteritems()
+                              if value != None and key in self.form_fields)
+        result = request.CLEANED.get('_obj')
+        if self.version_field:
+            result = self.update_object(object_id, changed_fields, self.expected_version(request))
+        elif result is None and self.update_instead_save:
+            # Write first, then read the row back once
+            result = self.update_object(object_id, changed_fields)
         else:
-            result = self.query_model.objects.get(id=object_id)
-        for key, value in request.CLEANED.iteritems():
-            if value != None and key in self.form_fields:
+            if result is None:
+                result = self.query_model.objects.get(id=object_id)
+            for key, value in changed_fields.iteritems():
                 setattr(result, key, value)
-                changed_fields[key] = value
-        if changed_fields:
-            if self.update_instead_save:
-                self.query_model.objects.filter(id=object_id).update(**changed_fields)
-            else:
-                result.save()
+            if changed_fields:
+                if self.update_instead_save:
+                    self.query_model.objects.filter(id=object_id).update(**changed_fields)
+                    # update() sends no signals
+                    if self.query_model in response_cache.WATCHED_MODELS:
+                        response_cache.invalidate_model(self.query_model)
+                else:
+                    result.save()
 
         if kwargs.get('raw'):
             return result
         # return ','.join(changed_fields)
         return result.to_json(request=request, detail=True)
 
+    def expected_version(self, request):
+        """
+        The versions the client accepts, from "If-Match" (e.g. '"3", "4"')
+        or the "version" parameter. None for "If-Match: *", any version will do.
+        """
+        header = request.META.get('HTTP_IF_MATCH')
+        if header:
+            if header.strip() == '*':
+                return None
+            versions = []
+            for version in header.split(','):
+                version = version.strip()
+                if version.startswith('W/'):
+                    version = version[2:]
+                versions.append(version.strip('"'))
+        else:
+            versions = [request.CLEANED.get('version')]
+        if versions[0] is None:
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'version' is missing in params.")
+        try:
+            return [int(version) for version in versions]
+        except (TypeError, ValueError):
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'version' is not a valid integer.")
+
+    def update_object(self, object_id, changed_fields, version=None):
+        """
+        Updates the object with `changed_fields` and returns it as stored.
+        With a `version` (or a list of them), the update only applies to
+        that version of the object.
+        """
+        query_set = self.query_model.objects.filter(id=object_id)
+        select, prefetch = self.related_lookups(True)
+        result = None
+
+        if changed_fields:
+            condition = query_set
+            if self.version_field:
+                # The version only moves forward
+                changed_fields.pop(self.version_field, None)
+                changed_fields = dict(changed_fields, **{self.version_field: F(self.version_field) + 1})
+            if isinstance(version, list):
+                condition = query_set.filter(**{self.version_field + '__in': version})
+            elif version is not None:
+                condition = query_set.filter(**{self.version_field: version})
+
+            connection = connections[query_set.db]
+            if self.update_returning and not select and supports_returning(connection):
+                results = update_returning(condition, changed_fields, self.update_read_fields)
+                if results is not None:
+                    if not results:
+                        self.not_updated(query_set, version)
+                    result = results[0]
+                    if prefetch:
+                        prefetch_related_objects([result], *prefetch)
+            if result is None and not condition.update(**changed_fields):
+                self.not_updated(query_set, version)
+            # update() sends no signals
+            if self.query_model in response_cache.WATCHED_MODELS:
+                response_cache.invalidate_model(self.query_model)
+
+        if result is None:
+            query_set = self.apply_related(query_set, True)
+            if self.update_read_fields:
+                # A relation can't be both deferred and joined by select_related
+                query_set = query_set.only(*unique([self.query_model._meta.pk.name] + list(self.update_read_fields)
+                                                   + [lookup.split('__')[0] for lookup in select]))
+            result = query_set.get()
+        return result
+
+    def not_updated(self, query_set, version=None):
+        """ Raises the reason why no row was updated. """
+        if version is not None and query_set.exists():
+            versions = version if isinstance(version, list) else [version]
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_CONFLICT,
+                "The object is not at version %s any more." % ' or '.join(map(str, versions)))
+        raise self.query_model.DoesNotExist('%s matching query does not exist.' % self.query_model._meta.object_name)
+
 
 
 # ============== Attribute Handler =============
@@ -0,0 +1,60 @@
+"""
+JSON codec used everywhere the framework encodes or decodes JSON.
+
+The backend is selected with `REST_API_JSON_BACKEND` in settings,
+'json' (default) or 'simplejson' when it can be imported. ujson and
+orjson are not offered: orjson doesn't run on Python 2 and ujson 1.35
+has no `default` hook, writes Decimal as a number and escapes '/'.
+Every backend hands datetimes, Decimal, UUID and lazy strings to
+Django's `DjangoJSONEncoder`, so the output is the same whichever
+backend is used. `dumps(data, default=f)` hands them to `f` instead.
+"""
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+DEFAULT_BACKEND = 'json'
+
+_default = DjangoJSONEncoder().default
+
+# name -> (dumps, loads)
+BACKENDS = {}
+
+
+def _json_dumps(data, indent=None, default=None):
+    return json.dumps(data, cls=DjangoJSONEncoder, default=default, ensure_ascii=False, indent=indent)
+
+BACKENDS['json'] = (_json_dumps, json.loads)
+
+
+if simplejson:
+    def _simplejson_dumps(data, indent=None, default=None):
+        # use_decimal=False leaves Decimal to DjangoJSONEncoder (as a string)
+        return simplejson.dumps(data, default=default or _default, use_decimal=False,
+                                ensure_ascii=False, indent=indent)
+
+    BACKENDS['simplejson'] = (_simplejson_dumps, simplejson.loads)
+
+
+def get_backend():
+    """ Returns the (dumps, loads) pair selected by `REST_API_JSON_BACKEND`. """
+    name = getattr(settings, 'REST_API_JSON_BACKEND', DEFAULT_BACKEND)
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ImproperlyConfigured("JSON backend '%s' is not available." % name)
+
+
+def dumps(data, indent=None, default=None):
+    return get_backend()[0](data, indent, default)
+
+
+def loads(s):
+    return get_backend()[1](s)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from rest_api import json_codec
+from rest_api.schema import generate_schema
+
+
+class Command(BaseCommand):
+    help = 'Writes the OpenAPI schema of the api, serve it with REST_API_SCHEMA_FILE.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-o', '--output', help='File to write, default: stdout.')
+        parser.add_argument('--indent', type=int, default=None)
+
+    def handle(self, *args, **options):
+        content = json_codec.dumps(generate_schema(), indent=options['indent'])
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+
+        if not options['output']:
+            self.stdout.write(content)
+            return
+        with open(options['output'], 'wb') as output:
+            output.write(content)
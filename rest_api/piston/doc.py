@@ -2,6 +2,7 @@ import inspect, handler
 
 from rest_api.piston.handler import typemapper
 from rest_api.piston.handler import handler_tracker
+from rest_api.piston.utils import getargspec
 
 from django.core.urlresolvers import get_resolver, get_callable, get_script_prefix
 from django.shortcuts import render_to_response
@@ -24,7 +25,7 @@ class HandlerMethod(object):
         self.stale = stale
         
     def iter_args(self):
-        args, _, _, defaults = inspect.getargspec(self.method)
+        args, _, _, defaults = getargspec(self.method)
 
         for idx, arg in enumerate(args):
             if arg in ('self', 'request', 'form'):
@@ -165,31 +166,31 @@ class HandlerDocumentation(object):
                         if set(kwargs.keys()) != set(params):
                             continue
                         return _convert(result, params)
-        except:
+        except Exception:
             return None
-        
-    resource_uri_template = property(get_resource_uri_template)
+
+    @property
+    def resource_uri_template(self):
+        # Resolved once, the URLconf doesn't change at run time
+        if not hasattr(self, '_resource_uri_template'):
+            self._resource_uri_template = self.get_resource_uri_template()
+        return self._resource_uri_template
     
     def __repr__(self):
         return u'<Documentation for "%s">' % self.name
 
+_docs = []
+
 def documentation_view(request):
     """
     Generic documentation view. Generates documentation
     from the handlers you've defined.
     """
-    docs = [ ]
-
-    for handler in handler_tracker: 
-        docs.append(generate_doc(handler))
-
-    def _compare(doc1, doc2): 
-       #handlers and their anonymous counterparts are put next to each other.
-       name1 = doc1.name.replace("Anonymous", "")
-       name2 = doc2.name.replace("Anonymous", "")
-       return cmp(name1, name2)    
- 
-    docs.sort(_compare)
-       
+    if len(_docs) != len(handler_tracker):
+        #handlers and their anonymous counterparts are put next to each other.
+        docs = [ generate_doc(handler) for handler in handler_tracker ]
+        docs.sort(key=lambda doc: doc.name.replace("Anonymous", ""))
+        _docs[:] = docs
+
     return render_to_response('documentation.html', 
-        { 'docs': docs }, RequestContext(request))
+        { 'docs': _docs }, RequestContext(request))
@@ -7,6 +7,14 @@ from django.conf import settings
 typemapper = { }
 handler_tracker = [ ]
 
+# Reverse index of `typemapper`, (model, is_anonymous) -> handler.
+# Kept in sync by `HandlerMetaClass`, first registration wins.
+handler_index = { }
+
+# Emitter serialization plans, compiled per model and reset
+# whenever a handler is registered (see `Emitter.model_plan`).
+serialization_plans = { }
+
 class HandlerMetaClass(type):
     """
     Metaclass that keeps a registry of class -> handler
@@ -16,9 +24,7 @@ class HandlerMetaClass(type):
         new_cls = type.__new__(cls, name, bases, attrs)
 
         def already_registered(model, anon):
-            for k, (m, a) in typemapper.iteritems():
-                if model == m and anon == a:
-                    return k
+            return handler_index.get((model, anon))
 
         if hasattr(new_cls, 'model'):
             if already_registered(new_cls.model, new_cls.is_anonymous):
@@ -27,12 +33,15 @@ class HandlerMetaClass(type):
                         "you may experience inconsistent results." % new_cls.model.__name__)
 
             typemapper[new_cls] = (new_cls.model, new_cls.is_anonymous)
+            handler_index.setdefault((new_cls.model, new_cls.is_anonymous), new_cls)
         else:
             typemapper[new_cls] = (None, new_cls.is_anonymous)
 
         if name not in ('BaseHandler', 'AnonymousBaseHandler'):
             handler_tracker.append(new_cls)
 
+        serialization_plans.clear()
+
         return new_cls
 
 class BaseHandler(object):
@@ -1,13 +1,15 @@
-import time
+import inspect
+import weakref
 from django.http import HttpResponseNotAllowed, HttpResponseForbidden, HttpResponse, HttpResponseBadRequest
 from django.core.urlresolvers import reverse
-from django.core.cache import cache
 from django import get_version as django_version
 from django.core.mail import send_mail, mail_admins
 from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.template import loader, TemplateDoesNotExist
 from rest_api.piston.decorator import decorator
+from rest_api import json_codec
+from rest_api.throttle import SlidingWindow
 
 from datetime import datetime, timedelta
 
@@ -16,10 +18,61 @@ __version__ = '0.2.3rc1'
 def get_version():
     return __version__
 
+_argspecs = weakref.WeakKeyDictionary()
+
+def getargspec(func):
+    """
+    `inspect.getargspec`, cached per function. Bound methods share
+    the entry of their function; entries go away with the function.
+    """
+    key = getattr(func, '__func__', func)
+    try:
+        return _argspecs[key]
+    except (KeyError, TypeError):
+        pass
+
+    spec = inspect.getargspec(func)
+    try:
+        _argspecs[key] = spec
+    except TypeError:
+        # Not weakly referenceable
+        pass
+    return spec
+
 def format_error(error):
     return u"Piston/%s (Django %s) crash report:\n\n%s" % \
         (get_version(), django_version(), error)
 
+class HttpResponseWrapper(HttpResponse):
+    """
+    Wrap HttpResponse and make sure that the internal _is_string 
+    flag is updated when the _set_content method (via the content 
+    property) is called
+    """
+    def _set_content(self, content):
+        """
+        Set the _container and _is_string properties based on the 
+        type of the value parameter. This logic is in the construtor
+        for HttpResponse, but doesn't get repeated when setting 
+        HttpResponse.content although this bug report (feature request)
+        suggests that it should: http://code.djangoproject.com/ticket/9403 
+        """
+        if not isinstance(content, basestring) and hasattr(content, '__iter__'):
+            self._container = content
+            self._is_string = False
+        else:
+            self._container = [content]
+            self._is_string = True
+
+    try:
+        # Django versoin is older than 1.5
+        content = property(HttpResponse._get_content, _set_content)
+    except:
+        # Django version 1.5
+        @HttpResponse.content.setter
+        def content(self, content):
+            self._set_content(content)
+
 class rc_factory(object):
     """
     Status codes.
@@ -47,36 +100,6 @@ class rc_factory(object):
         except TypeError:
             raise AttributeError(attr)
 
-        class HttpResponseWrapper(HttpResponse):
-            """
-            Wrap HttpResponse and make sure that the internal _is_string 
-            flag is updated when the _set_content method (via the content 
-            property) is called
-            """
-            def _set_content(self, content):
-                """
-                Set the _container and _is_string properties based on the 
-                type of the value parameter. This logic is in the construtor
-                for HttpResponse, but doesn't get repeated when setting 
-                HttpResponse.content although this bug report (feature request)
-                suggests that it should: http://code.djangoproject.com/ticket/9403 
-                """
-                if not isinstance(content, basestring) and hasattr(content, '__iter__'):
-                    self._container = content
-                    self._is_string = False
-                else:
-                    self._container = [content]
-                    self._is_string = True
-
-            try:
-                # Django versoin is older than 1.5
-                content = property(HttpResponse._get_content, _set_content)
-            except:
-                # Django version 1.5
-                @HttpResponse.content.setter
-                def content(self, content):
-                    self._set_content(content)
-
         return HttpResponseWrapper(r, content_type='text/plain', status=c)
     
 rc = rc_factory()
@@ -103,8 +126,9 @@ def validate(v_form, operation='POST'):
 
 def throttle(max_requests, timeout=60*60, extra=''):
     """
-    Simple throttling decorator, caches
-    the amount of requests made in cache.
+    Simple throttling decorator, counts the requests
+    made with `rest_api.throttle.SlidingWindow`, which
+    uses atomic cache operations.
     
     If used on a view where users are required to
     log in, the username is used, otherwise the
@@ -112,8 +136,10 @@ def throttle(max_requests, timeout=60*60, extra=''):
     
     Parameters::
      - `max_requests`: The maximum number of requests
-     - `timeout`: The timeout for the cache entry (default: 1 hour)
+     - `timeout`: The length of the window (default: 1 hour)
     """
+    limit = SlidingWindow(max_requests, timeout)
+
     @decorator
     def wrap(f, self, request, *args, **kwargs):
         if request.user.is_authenticated():
@@ -131,28 +157,14 @@ def throttle(max_requests, timeout=60*60, extra=''):
             ident += ':%s' % str(request.throttle_extra)
         
         if ident:
-            """
-            Preferrably we'd use incr/decr here, since they're
-            atomic in memcached, but it's in django-trunk so we
-            can't use it yet. If someone sees this after it's in
-            stable, you can change it here.
-            """
             ident += ':%s' % extra
-    
-            now = time.time()
-            count, expiration = cache.get(ident, (1, None))
-
-            if expiration is None:
-                expiration = now + timeout
 
-            if count >= max_requests and expiration > now:
+            wait = limit.hit(ident)
+            if wait:
                 t = rc.THROTTLED
-                wait = int(expiration - now)
                 t.content = 'Throttled, wait %d seconds.' % wait
                 t['Retry-After'] = wait
                 return t
-
-            cache.set(ident, (count+1, expiration), (expiration - now))
     
         return f(self, request, *args, **kwargs)
     return wrap
@@ -259,7 +271,7 @@ class Mimer(object):
             
             if loadee:
                 try:
-                    self.request.data = loadee(self.request.body)
+                    self.request.data = parse_body(self.request, loadee)
                         
                     # Reset both POST and PUT from request, as its
                     # misleading having their presence around.
@@ -280,6 +292,19 @@ class Mimer(object):
     def unregister(cls, loadee):
         return cls.TYPES.pop(loadee)
 
+def parse_body(request, loadee=json_codec.loads):
+    """
+    Deserializes the request body with `loadee`. The result
+    is cached on the request, so `translate_mime` and the
+    argument cleaning in `process_request` share one parse.
+    """
+    parsed = request.__dict__.setdefault('_parsed_body', {})
+
+    if loadee not in parsed:
+        parsed[loadee] = loadee(request.body)
+
+    return parsed[loadee]
+
 def translate_mime(request):
     request = Mimer(request).translate()
     
@@ -1,76 +1,125 @@
 import sys
+import time
 import traceback
-import json
+from calendar import timegm
 
 from django.core.signals import got_request_exception
-from django.http import Http404, HttpResponse, HttpResponseServerError, HttpResponseNotAllowed
+from django.http import Http404, HttpResponse, HttpResponseServerError, HttpResponseNotAllowed,\
+    StreamingHttpResponse
 from django.views.debug import ExceptionReporter
 from django.views.decorators.vary import vary_on_headers
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db import DatabaseError
+from django.db import DatabaseError, connection
 from django.core.mail import send_mail, EmailMessage
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
 
-from rest_api.emitters import Emitter
+from rest_api.emitters import Emitter, ELIMINATE_INDENT
 from rest_api.piston.doc import HandlerMethod
 from rest_api.piston.handler import typemapper
 from rest_api.piston.resource import Resource
 from rest_api.piston.utils import rc, translate_mime, MimerDataException, HttpStatusCode,\
-    format_error
+    HttpResponseWrapper, format_error
 
 from rest_api import errors as api_errors
+from rest_api import json_codec
+from rest_api import response_cache
+from rest_api.throttle import get_ident
+from rest_api.timing import PhaseTimer, NULL_TIMER, get_sink, start_profile, finish_profile
 from rest_api.utils import process_request
 
 
-def make_error_response(code, debug=None):
-    """ Creates an error response for error code `code`.  If code is invalid, returns
-    the default 'unknown error' response. """
+# (code, message, status) -> encoded body, filled by `error_body`
+_error_bodies = {}
+
+
+def error_body(code):
+    """
+    The status and the encoded body (without debug) of error `code`,
+    encoded once per message: API_ERRORS may change at run time.
+    """
+    content = {'error': api_errors.error_content(code)}
+    status = api_errors.ERROR_STATUS.get(code, 400)
+    # unicode() also tells the languages of a lazy message apart
+    key = (code, unicode(content['error']['message']), status)
     try:
-        error_code, error_message = code, api_errors.API_ERRORS[code]
+        return status, _error_bodies[key]
     except KeyError:
-        error_code, error_message = api_errors.ERROR_GENERAL_UNKNOWN_ERROR,\
-            api_errors.API_ERRORS[api_errors.ERROR_GENERAL_UNKNOWN_ERROR]
-    
-    content = {
-        'error': {
-            'code': error_code,
-            'message': error_message,
-        }
-    }
+        pass
+    body = json_codec.dumps(content) if ELIMINATE_INDENT else json_codec.dumps(content, indent=3)
+    _error_bodies[key] = body
+    return status, body
+
 
+def make_error_response(code, debug=None):
+    """ Creates an error response for error code `code`.  If code is invalid, returns
+    the default 'unknown error' response. """
+    status, body = error_body(code)
     if debug:
-        content['error']['debug'] = debug
-    
-    result = rc.BAD_REQUEST
-    if code == api_errors.ERROR_AUTH_NOT_AUTHENTICATED:
-        result = rc.FORBIDDEN
-    elif code == api_errors.ERROR_AUTH_BAD_CREDENTIALS:
-        result = rc.FORBIDDEN
-    elif code == api_errors.ERROR_AUTH_NOT_AUTHORIZED:
-        result = rc.FORBIDDEN
-    elif code == api_errors.ERROR_GENERAL_BAD_SIGNATURE:
-        result = rc.BAD_REQUEST
-    elif code == api_errors.ERROR_GENERAL_UNKNOWN_ERROR:
-        result = rc.INTERNAL_ERROR
-    elif code == api_errors.ERROR_GENERAL_NOT_FOUND:
-        result = rc.NOT_FOUND
+        # Rendered by the emitter like other content
+        result = HttpResponseWrapper(status=status)
+        result.content = {'error': api_errors.error_content(code, debug)}
     else:
-        result = rc.BAD_REQUEST
-
-    result.content = content
-
+        result = HttpResponseWrapper(body, content_type='application/json; charset=utf-8', status=status)
+    result.error_code = code
     return result
 
 CHALLENGE = object()
 
 
 class BaseResource(Resource):
+    callmap = dict(Resource.callmap, PATCH='update')
+
+    def __init__(self, handler):
+        super(BaseResource, self).__init__(handler)
+        self.count_queries = getattr(settings, 'REST_API_QUERY_COUNT_HEADER', False)
+        self.timing = getattr(settings, 'REST_API_TIMING', False)
+        self.profiling = bool(getattr(settings, 'REST_API_PROFILE_SAMPLE_RATE', 0))
+        if (self.handler.cache_timeout or self.handler.count_total) and self.handler.query_model:
+            response_cache.watch_model(self.handler.query_model)
     
     @vary_on_headers('Authorization')
     def __call__(self, request, *args, **kwargs):
+        if not (self.count_queries or self.timing or self.profiling):
+            return self.serve(request, *args, **kwargs)
+        return self.instrumented_serve(request, *args, **kwargs)
+
+    def instrumented_serve(self, request, *args, **kwargs):
+        """
+        `serve` with the debug headers, timings and profiling turned on in
+        settings. Work done while streaming the response is not counted.
+        """
+        count_queries = self.count_queries or self.timing
+        debug_cursor = connection.force_debug_cursor
+        if count_queries:
+            connection.force_debug_cursor = True
+        initial_queries = len(connection.queries_log)
+        request.timer = PhaseTimer(connection) if self.timing else NULL_TIMER
+
+        started = time.time()
+        profile = start_profile() if self.profiling else None
+        try:
+            resp = self.serve(request, *args, **kwargs)
+        finally:
+            connection.force_debug_cursor = debug_cursor
+            if profile:
+                finish_profile(profile, self.handler.__class__.__name__, (time.time() - started) * 1000)
+
+        if self.count_queries:
+            resp['X-Query-Count'] = len(connection.queries_log) - initial_queries
+        if self.timing:
+            resp['Server-Timing'] = request.timer.header()
+            sink = get_sink()
+            if sink:
+                sink.record(self, request, resp, request.timer)
+        return resp
+
+    def serve(self, request, *args, **kwargs):
         rm = request.method.upper()
         handler, anonymous = self.handler, self.handler.is_anonymous
+        timer = getattr(request, 'timer', NULL_TIMER)
 
         if rm == 'PUT' and request.META['CONTENT_TYPE']=="application/json":
             rm = request.method = 'POST'
@@ -96,9 +145,41 @@ class BaseResource(Resource):
 
         request = self.cleanup_request(request)
 
+        etag = last_modified = retry_after = cache_key = None
         try:
+            if handler.rate_limits:
+                retry_after = self.check_rate_limits(request, rm)
+                if retry_after:
+                    raise api_errors.GlobalAPIException(api_errors.ERROR_GENERAL_THROTTLED,
+                        'Throttled, wait %d seconds.' % retry_after)
+
+            # Serve identical GET requests from the response cache
+            if rm == 'GET' and handler.cache_timeout:
+                cache_key = response_cache.make_key(handler, request, args, kwargs)
+                if cache_key:
+                    cached = response_cache.get_response(cache_key)
+                    if cached is not None:
+                        # Conditional GET against the validators stored with it
+                        last_modified = cached.get('Last-Modified')
+                        return get_conditional_response(
+                            request, etag=cached.get('ETag'), response=cached,
+                            last_modified=last_modified and parse_http_date_safe(last_modified))
+
             # The verified process of new api is all in process_request
             request = process_request(handler, request, *args, **kwargs)
+
+            # Conditional GET, answer 304 before the handler queries anything
+            if rm == 'GET':
+                etag, last_modified = self.get_validators(request, *args, **kwargs)
+                not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+                if not_modified is not None:
+                    return not_modified
+            timer.lap('clean')
+
+            # A JSON array posted to a bulk handler, see process_request
+            if getattr(request, 'BULK', None) is not None:
+                meth = handler.bulk_create
+
             raw_response = meth(request, *args, **kwargs)
             # An implicit protocal for deliver info from handler
             use_wrapper = False
@@ -125,6 +206,7 @@ class BaseResource(Resource):
 
         except Exception, e:
             result = self.error_handler(e, request, meth)
+        timer.lap('handler')
 
         emitter, ct = Emitter.get('json')
         fields = handler.fields
@@ -132,6 +214,10 @@ class BaseResource(Resource):
         if hasattr(handler, 'list_fields') and isinstance(result, (list, tuple, QuerySet)):
             fields = handler.list_fields
 
+        # Sparse fieldsets also apply to the models the emitter serializes
+        if rm == 'GET' and handler.sparse_fields and getattr(request, 'CLEANED', None):
+            fields = request.CLEANED.get('fields') or fields
+
         status_code = 200
         
         # If we're looking at a response object which contains non-string
@@ -144,24 +230,52 @@ class BaseResource(Resource):
             # when _is_string is False _container is the raw data
             result = result._container
      
-        srl = emitter(result, typemapper, handler, fields, anonymous)
-
         try:
-            """
-            Decide whether or not we want a generator here,
-            or we just want to buffer up the entire result
-            before sending it to the client. Won't matter for
-            smaller datasets, but larger will have an impact.
-            """
-            if self.stream: stream = srl.stream_render(request)
-            else: stream = srl.render(request)
-
-            if not isinstance(stream, HttpResponse):
-                resp = HttpResponse(stream, content_type=ct, status=status_code)
+            if isinstance(result, HttpResponse):
+                # Encoded already, the emitter would only hand it back
+                if getattr(result, 'error_code', None) is None:
+                    return result
+                resp = result
+                status_code = resp.status_code
+                cb = request.GET.get('callback')
+                if cb:
+                    resp.content = '%s(%s)' % (cb, resp.content)
             else:
-                resp = stream
+                srl = emitter(result, typemapper, handler, fields, anonymous)
+                """
+                Decide whether or not we want a generator here,
+                or we just want to buffer up the entire result
+                before sending it to the client. Won't matter for
+                smaller datasets, but larger will have an impact.
+                """
+                if self.stream: stream = srl.stream_render(request)
+                elif timer is not NULL_TIMER and hasattr(srl, 'encode'):
+                    data = srl.construct()
+                    timer.lap('construct')
+                    stream = srl.encode(request, data)
+                    timer.lap('encode')
+                else: stream = srl.render(request)
+
+                if self.stream:
+                    resp = StreamingHttpResponse(stream, content_type=ct, status=status_code)
+                elif not isinstance(stream, HttpResponse):
+                    resp = HttpResponse(stream, content_type=ct, status=status_code)
+                else:
+                    resp = stream
+
+                resp.streaming = self.stream
+
+            if retry_after:
+                resp['Retry-After'] = retry_after
+
+            if status_code == 200:
+                if etag:
+                    resp['ETag'] = etag
+                if last_modified:
+                    resp['Last-Modified'] = http_date(last_modified)
 
-            resp.streaming = self.stream
+            if cache_key and status_code == 200 and not self.stream:
+                response_cache.set_response(cache_key, resp, handler.cache_timeout)
 
             if request.method == "OPTIONS":
                 # Try to make it accessible for google index search
@@ -174,6 +288,40 @@ class BaseResource(Resource):
         except HttpStatusCode, e:
             return e.response
 
+    def check_rate_limits(self, request, rm):
+        """
+        Counts the request against the `rate_limits` of the handler.
+        Returns 0 if it is allowed, otherwise the seconds to wait.
+        """
+        ident = '%s:%s' % (self.handler.__class__.__name__, get_ident(request))
+
+        for limit in self.handler.rate_limits:
+            if limit.applies_to(rm):
+                wait = limit.hit(ident)
+                if wait:
+                    return wait
+        return 0
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Calls the optional `etag` and `last_modified` hooks of the
+        handler. Returns the quoted ETag and the last modified
+        timestamp, both None when the handler has no hook.
+        """
+        etag = last_modified = None
+
+        if self.handler.etag:
+            etag = self.handler.etag(request, *args, **kwargs)
+            if etag:
+                etag = quote_etag(etag)
+
+        if self.handler.last_modified:
+            modified = self.handler.last_modified(request, *args, **kwargs)
+            if modified:
+                last_modified = timegm(modified.utctimetuple())
+
+        return etag, last_modified
+
     def email_exception(self, reporter):
         # Implement your email method
         """
@@ -226,13 +374,13 @@ class BaseResource(Resource):
             if self.email_errors:
                 self.email_exception(rep)
 
-            result.content = json.dumps({
+            result.content = json_codec.dumps({
                 'success': False,
                 'error': {
                     'code': api_errors.ERROR_GENERAL_BAD_SIGNATURE,
                     'message': msg,
                 }
-            }, ensure_ascii=False, indent=3)
+            }, indent=3)
             return result
         
         elif isinstance(e, Http404):
@@ -0,0 +1,111 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse
+
+from rest_api.errors import GlobalAPIException
+from rest_api.utils import parse_pagination
+
+# GET parameters which are always part of the cleaned request.
+PAGINATION_PARAMS = ('offset', 'limit', 'order_by', 'detail', 'cursor', 'fields', 'callback', 'format')
+
+KEY_PREFIX = 'rest_api:response'
+
+# Headers kept with a cached response, they answer conditional requests on a cache hit.
+VALIDATORS = ('ETag', 'Last-Modified')
+
+# Models whose save/delete invalidate cached responses
+WATCHED_MODELS = set()
+
+
+def get_cache():
+    return caches[getattr(settings, 'REST_API_CACHE_ALIAS', 'default')]
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def generation_key(model):
+    return '%s:generation:%s' % (KEY_PREFIX, model_label(model))
+
+
+def invalidate_model(model, **kwargs):
+    """ Drops every cached response of handlers whose `query_model` is `model`. """
+    cache = get_cache()
+    key = generation_key(model)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr()
+            cache.set(key, 1, None)
+
+
+def _invalidate_sender(sender, **kwargs):
+    invalidate_model(sender)
+
+
+def watch_model(model):
+    """ Invalidates cached responses when an instance of `model` is saved or deleted. """
+    uid = '%s:%s' % (KEY_PREFIX, model_label(model))
+    WATCHED_MODELS.add(model)
+    post_save.connect(_invalidate_sender, sender=model, dispatch_uid=uid)
+    post_delete.connect(_invalidate_sender, sender=model, dispatch_uid=uid)
+
+
+def make_key(handler, request, args, kwargs):
+    """
+    Builds the cache key of a GET request from the path, the parameters
+    kept by the handler (normalized like `process_request` does), the
+    `cache_vary_on` headers and the user. Every logged in user gets
+    their own entries, anonymous users share theirs. Returns None if the
+    request can't be cached.
+    """
+    try:
+        offset, limit = parse_pagination(request.GET.get('offset'), request.GET.get('limit'))
+    except GlobalAPIException:
+        return None
+
+    params = {'offset': offset, 'limit': limit, 'detail': request.GET.get('detail') == 'true'}
+    for key in PAGINATION_PARAMS + tuple(argument[0] for argument in handler.request_schema().read):
+        if key not in params and request.GET.get(key) is not None:
+            params[key] = request.GET.get(key)
+
+    headers = [request.META.get('HTTP_' + header.upper().replace('-', '_')) for header in handler.cache_vary_on]
+
+    # A hit skips process_request, so requests it would refuse aren't looked up.
+    user = None
+    if request.user.is_authenticated():
+        user = request.user.pk
+    elif not handler.read_auth_exempt:
+        return None
+    if handler.superuser_only and not request.user.is_superuser:
+        return None
+
+    raw = repr((request.path, sorted(params.items()), headers, user, args, sorted(kwargs.items())))
+    digest = hashlib.md5(raw).hexdigest()
+
+    generation = 0
+    if handler.query_model:
+        generation = get_cache().get(generation_key(handler.query_model), 0)
+
+    return '%s:%s:%s:%s' % (KEY_PREFIX, handler.__class__.__name__, generation, digest)
+
+
+def get_response(key):
+    cached = get_cache().get(key)
+    if cached is None:
+        return None
+    content, content_type, validators = cached
+    response = HttpResponse(content, content_type=content_type)
+    for header, value in validators:
+        response[header] = value
+    return response
+
+
+def set_response(key, response, timeout):
+    validators = [(header, response[header]) for header in VALIDATORS if response.has_header(header)]
+    get_cache().set(key, (response.content, response['Content-Type'], validators), timeout)
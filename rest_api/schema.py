@@ -0,0 +1,159 @@
+"""
+OpenAPI (3.0) description of the api, generated from the handlers
+of the `BaseResource` views in the URLconf: `allowed_methods`,
+`read_kwargs`, `required_fields_for_read`, `create_kwargs`,
+`required_fields`, `delete_kwargs`, `form_fields`, `allowed_filter`
+and `field_types`.
+
+The schema is generated once and served from memory by `schema_view`.
+`python manage.py api_schema -o schema.json` writes it to a file; with
+`REST_API_SCHEMA_FILE` pointing to that file, the view serves the file
+and nothing is generated at run time.
+"""
+import inspect
+import os
+
+from django.conf import settings
+from django.core.urlresolvers import get_resolver
+from django.http import HttpResponse
+from django.utils.regex_helper import normalize
+
+from rest_api import json_codec
+from rest_api.handler import BaseHandler, BaseIndexHandler
+from rest_api.resources import BaseResource
+
+OPERATIONS = (('GET', 'get', 'read'), ('POST', 'post', 'create'),
+              ('PATCH', 'patch', 'update'), ('DELETE', 'delete', 'delete'))
+
+# field_types -> OpenAPI schema
+TYPE_SCHEMAS = {
+    'int': {'type': 'integer'},
+    'float': {'type': 'number'},
+    'bool': {'type': 'boolean'},
+    'list': {'type': 'array', 'items': {'type': 'string'}},
+    'timestamp': {'type': 'number', 'description': 'unix timestamp'},
+    'latlon': {'type': 'string', 'description': 'latitude,longitude'},
+}
+
+_content = None
+
+
+def iter_resources(patterns, prefix=''):
+    """ Yields (path regex, resource) for every BaseResource view. """
+    for pattern in patterns:
+        regex = prefix + pattern.regex.pattern.lstrip('^')
+        if hasattr(pattern, 'url_patterns'):
+            for item in iter_resources(pattern.url_patterns, regex.rstrip('$')):
+                yield item
+        elif isinstance(pattern.callback, BaseResource) and isinstance(pattern.callback.handler, BaseHandler):
+            yield regex, pattern.callback
+
+
+def field_schema(handler, name):
+    field_type = handler.field_types.get(name)
+    if isinstance(field_type, (list, tuple)):
+        return {'type': 'integer', 'enum': [choice[0] for choice in field_type]}
+    return dict(TYPE_SCHEMAS.get(field_type, {'type': 'string'}))
+
+
+def query_parameter(name, schema, required=False):
+    return {'name': name, 'in': 'query', 'required': required, 'schema': schema}
+
+
+def body_schema(handler, names, required=()):
+    schema = {
+        'type': 'object',
+        'properties': dict((name, field_schema(handler, name)) for name in names),
+    }
+    required = [name for name in names if name in required]
+    if required:
+        schema['required'] = required
+    return {'required': True, 'content': {'application/json': {'schema': schema}}}
+
+
+def selection_parameters(handler):
+    """ The query parameters selecting the objects of a bulk update / delete. """
+    parameters = [query_parameter('ids', {'type': 'string', 'description': 'comma separated ids'})]
+    parameters += [query_parameter(name, field_schema(handler, name)) for name in handler.allowed_filter]
+    return parameters
+
+
+def read_parameters(handler):
+    parameters = [
+        query_parameter('offset', {'type': 'integer', 'minimum': 0}),
+        query_parameter('limit', {'type': 'integer', 'minimum': 1}),
+        query_parameter('order_by', {'type': 'string'}),
+        query_parameter('detail', {'type': 'boolean'}),
+    ]
+    if handler.cursor_fields:
+        parameters.append(query_parameter('cursor', {'type': 'string'}))
+    if handler.sparse_fields:
+        parameters.append(query_parameter('fields', {'type': 'string', 'description': 'comma separated, of: %s' % ', '.join(handler.sparse_fields)}))
+    for kwarg, required, coerce in handler.request_schema().read:
+        parameters.append(query_parameter(kwarg, field_schema(handler, kwarg), required))
+    return parameters
+
+
+def describe_operation(handler, method, meth, path_parameters):
+    operation = {
+        'operationId': '%s.%s' % (handler.__class__.__name__, method.lower()),
+        'parameters': list(path_parameters),
+        'responses': {'200': {'description': 'OK'}},
+    }
+    doc = inspect.getdoc(meth) or inspect.getdoc(handler)
+    if doc:
+        operation['summary'] = doc.strip().splitlines()[0]
+
+    bulk = isinstance(handler, BaseIndexHandler)
+    if method == 'GET':
+        operation['parameters'] += read_parameters(handler)
+    elif method == 'POST':
+        kwargs = [kwarg for kwarg, required, coerce in handler.request_schema().create]
+        operation['requestBody'] = body_schema(handler, kwargs, handler.required_fields)
+    elif method == 'PATCH':
+        operation['requestBody'] = body_schema(handler, handler.form_fields)
+        if bulk:
+            operation['parameters'] += selection_parameters(handler)
+    elif method == 'DELETE':
+        operation['parameters'] += [query_parameter(kwarg, field_schema(handler, kwarg)) for kwarg in handler.delete_kwargs]
+        if bulk:
+            operation['parameters'] += selection_parameters(handler)
+    return operation
+
+
+def generate_schema(urlconf=None):
+    """ Builds the OpenAPI document of the resources in `urlconf`. """
+    info = getattr(settings, 'REST_API_SCHEMA_INFO', {'title': 'API', 'version': '1.0'})
+    paths = {}
+
+    for regex, resource in iter_resources(get_resolver(urlconf).url_patterns):
+        handler = resource.handler
+        template, params = normalize(regex)[0]
+        path = '/' + template % dict((param, '{%s}' % param) for param in params)
+        path_parameters = [{'name': param, 'in': 'path', 'required': True, 'schema': {'type': 'string'}}
+                           for param in params]
+
+        item = paths.setdefault(path, {})
+        for method, key, name in OPERATIONS:
+            meth = getattr(handler, resource.callmap.get(method, name), None)
+            if method in handler.allowed_methods and meth:
+                item[key] = describe_operation(handler, method, meth, path_parameters)
+
+    return {'openapi': '3.0.0', 'info': info, 'paths': paths}
+
+
+def get_schema_content():
+    """ The encoded schema, made (or read from REST_API_SCHEMA_FILE) once per process. """
+    global _content
+    if _content is None:
+        path = getattr(settings, 'REST_API_SCHEMA_FILE', None)
+        if path and os.path.exists(path):
+            with open(path) as schema_file:
+                _content = schema_file.read()
+        else:
+            _content = json_codec.dumps(generate_schema())
+    return _content
+
+
+def schema_view(request):
+    return HttpResponse(get_schema_content(), content_type='application/json; charset=utf-8')
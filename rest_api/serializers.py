@@ -0,0 +1,117 @@
+"""
+Declarative `to_json` for models.
+
+Instead of writing `to_json` by hand, a model lists what it returns::
+
+    class Article(JSONModel, models.Model):
+        json_spec = JSONSpec(
+            fields=('id', 'title', 'created', ('author', 'author__username')),
+            detail_fields=('body', 'words'),
+            computed={'words': lambda row, request: len(row['body'].split())})
+
+Entries of `fields` (always returned) and `detail_fields` (only with
+detail) are model fields or `(key, lookup)` pairs following relations.
+A key named in `computed` is worked out by its function from the row
+built so far and the request.
+
+The spec is compiled once per model into a `RowSerializer` which turns
+model objects, or the `.values()` rows of its `lookups()`, into the
+same dicts. `BaseIndexHandler` with `values_rows` uses the latter, so
+list endpoints don't create model objects at all.
+"""
+from operator import attrgetter
+
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+
+_serializers = {}
+
+
+class JSONSpec(object):
+    def __init__(self, fields=(), detail_fields=(), computed=None):
+        self.fields = fields
+        self.detail_fields = detail_fields
+        self.computed = computed or {}
+
+
+def lookup_getter(model, lookup):
+    """ Returns a function reading `lookup` of an object, the value `.values(lookup)` would give. """
+    parts = lookup.split('__')
+    try:
+        field = model._meta.get_field(parts[0])
+    except FieldDoesNotExist:
+        raise ImproperlyConfigured("%s has no field '%s' (json_spec)." % (model.__name__, parts[0]))
+    if field.many_to_many or field.one_to_many:
+        raise ImproperlyConfigured("'%s' of %s is a multi valued relation, use computed (json_spec)." % (parts[0], model.__name__))
+
+    if len(parts) == 1:
+        return attrgetter(field.attname)
+
+    def get(obj):
+        for part in parts:
+            if obj is None:
+                return None
+            obj = getattr(obj, part)
+        return obj
+    return get
+
+
+class RowSerializer(object):
+    """ The `JSONSpec` of a model, compiled. """
+    def __init__(self, model, spec):
+        self.model = model
+        # detail -> [(key, lookup, getter)], [(key, function)]
+        self.plain = {}
+        self.computed = {}
+        entries = []
+        for detail, names in ((False, spec.fields), (True, spec.detail_fields)):
+            for entry in names:
+                key, lookup = entry if isinstance(entry, (list, tuple)) else (entry, entry)
+                if key in spec.computed:
+                    entries.append((key, None, spec.computed[key]))
+                else:
+                    entries.append((key, lookup, lookup_getter(model, lookup)))
+            self.plain[detail] = [entry for entry in entries if entry[1] is not None]
+            self.computed[detail] = [(key, function) for key, lookup, function in entries if lookup is None]
+
+    def select(self, detail, fields=None):
+        """ The plain and computed entries to serialize, computed keys need the whole row. """
+        plain, computed = self.plain[detail], self.computed[detail]
+        if fields is None or any(key in fields for key, function in computed):
+            return plain, computed
+        return [entry for entry in plain if entry[0] in fields], ()
+
+    def lookups(self, detail=False, fields=None):
+        """ The `.values()` arguments of the rows `from_values` takes. """
+        return [lookup for key, lookup, get in self.select(detail, fields)[0]]
+
+    def from_instance(self, obj, request=None, detail=False, fields=None):
+        plain, computed = self.select(detail, fields)
+        ret = dict((key, get(obj)) for key, lookup, get in plain)
+        for key, function in computed:
+            ret[key] = function(ret, request)
+        return ret
+
+    def from_values(self, row, request=None, detail=False, fields=None):
+        plain, computed = self.select(detail, fields)
+        ret = dict((key, row[lookup]) for key, lookup, get in plain)
+        for key, function in computed:
+            ret[key] = function(ret, request)
+        return ret
+
+
+def get_serializer(model):
+    """ The `RowSerializer` of `model.json_spec`, compiled once per model. """
+    serializer = _serializers.get(model)
+    if serializer is None:
+        if getattr(model, 'json_spec', None) is None:
+            raise ImproperlyConfigured('%s has no json_spec.' % model.__name__)
+        serializer = _serializers[model] = RowSerializer(model, model.json_spec)
+    return serializer
+
+
+class JSONModel(object):
+    """ Gives a model with a `json_spec` its `to_json`. """
+    json_spec = None
+
+    def to_json(self, request=None, detail=False, fields=None, **kwargs):
+        return get_serializer(type(self)).from_instance(self, request, detail, fields)
@@ -0,0 +1,197 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Local (per process) bookkeeping is dropped once it tracks that many clients.
+MAX_LOCAL_ENTRIES = 10000
+
+
+def get_cache():
+    return caches[getattr(settings, 'REST_API_THROTTLE_CACHE_ALIAS', 'default')]
+
+
+def incr(cache, key, delta, timeout):
+    """ Atomically adds `delta` to `key`, creating it when missing. """
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, timeout):
+            return delta
+        return cache.incr(key, delta)
+
+
+def remember(local, key, value):
+    if len(local) > MAX_LOCAL_ENTRIES:
+        local.clear()
+    local[key] = value
+
+
+class RateLimit(object):
+    """
+    Base class of the rate limits. Subclasses implement `consume`
+    with atomic cache operations (`add` / `incr`), so no count is
+    lost under concurrency.
+
+    Two local pre-filters save cache round trips:
+     - a client which is clearly under the limit leases a batch of
+       `lease_ratio * max_requests` requests at once and spends
+       them without touching the cache;
+     - a throttled client is refused locally until it may retry.
+    Both make the limit slightly stricter, never looser, than the
+    configured one.
+
+    Parameters::
+     - `max_requests`: The maximum number of requests per `period`
+     - `period`: Seconds (default: 1 minute)
+     - `methods`: Only count these request methods (default: all)
+    """
+    lease_ratio = 0.05
+
+    def __init__(self, max_requests, period=60, methods=None):
+        self.max_requests = max_requests
+        self.period = period
+        self.methods = methods
+        self.key_prefix = 'rest_api:throttle:%s:%s:%s' % (
+            self.__class__.__name__, max_requests, period)
+        self.leases = {}
+        self.blocked = {}
+
+    def applies_to(self, method):
+        return self.methods is None or method in self.methods
+
+    def hit(self, ident):
+        """
+        Counts one request of `ident`. Returns 0 if it is allowed,
+        otherwise the number of seconds to wait.
+        """
+        now = time.time()
+
+        blocked_until = self.blocked.get(ident)
+        if blocked_until:
+            if blocked_until > now:
+                return int(math.ceil(blocked_until - now))
+            self.blocked.pop(ident, None)
+
+        left, expires = self.leases.get(ident, (0, 0))
+        if left > 0 and expires > now:
+            self.leases[ident] = (left - 1, expires)
+            return 0
+
+        size = int(self.max_requests * self.lease_ratio)
+        if size > 1 and not self.consume(ident, size, now):
+            remember(self.leases, ident, (size - 1, now + self.lease_timeout(size, now)))
+            return 0
+
+        wait = self.consume(ident, 1, now)
+        if wait:
+            remember(self.blocked, ident, now + wait)
+        return wait
+
+    def consume(self, ident, cost, now):
+        """
+        Takes `cost` requests from the shared counters, returns
+        0 or the seconds to wait. Nothing is taken when refused.
+        """
+        raise NotImplementedError("Please implement consume.")
+
+    def lease_timeout(self, size, now):
+        raise NotImplementedError("Please implement lease_timeout.")
+
+
+class SlidingWindow(RateLimit):
+    """
+    Sliding window counter. The count of the previous fixed
+    window is weighted by how much of it still overlaps the
+    sliding window, which smooths out bursts at window edges.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SlidingWindow, self).__init__(*args, **kwargs)
+        # ident -> (window, count) of finished windows, they don't change anymore
+        self.previous = {}
+
+    def consume(self, ident, cost, now):
+        cache = get_cache()
+        window = int(now // self.period)
+        key = '%s:%s:%s' % (self.key_prefix, ident, window)
+
+        current = incr(cache, key, cost, self.period * 2)
+
+        previous_window, previous = self.previous.get(ident, (None, 0))
+        if previous_window != window - 1:
+            previous = cache.get('%s:%s:%s' % (self.key_prefix, ident, window - 1), 0)
+            remember(self.previous, ident, (window - 1, previous))
+
+        into = now % self.period
+        if previous * (1 - into / float(self.period)) + current > self.max_requests:
+            cache.decr(key, cost)
+            if previous and current <= self.max_requests:
+                # Wait until enough of the previous window slid out.
+                wait = self.period * (1 - (self.max_requests - current) / float(previous)) - into
+            else:
+                wait = self.period - into
+            return max(1, int(math.ceil(wait)))
+        return 0
+
+    def lease_timeout(self, size, now):
+        return self.period - now % self.period
+
+
+class TokenBucket(RateLimit):
+    """
+    Token bucket holding up to `burst` tokens (default:
+    `max_requests`) and refilled with `max_requests / period`
+    tokens per second. The bucket is kept as an epoch and a
+    consumed counter, tokens = burst + earned - consumed where
+    earned = (now - epoch) * rate; the epoch moves forward when
+    an idle client would have more than `burst` tokens.
+    """
+    # Counters live a day, their expiry leaks at most one burst.
+    timeout = 24 * 60 * 60
+
+    def __init__(self, max_requests, period=60, methods=None, burst=None):
+        super(TokenBucket, self).__init__(max_requests, period, methods)
+        self.rate = max_requests / float(period)
+        self.burst = burst or max_requests
+        self.epochs = {}
+
+    def load_epoch(self, cache, ident, default):
+        key = '%s:%s:epoch' % (self.key_prefix, ident)
+        cache.add(key, default, self.timeout)
+        epoch = cache.get(key, default)
+        remember(self.epochs, ident, epoch)
+        return epoch
+
+    def consume(self, ident, cost, now):
+        cache = get_cache()
+        key = '%s:%s:consumed' % (self.key_prefix, ident)
+
+        consumed = incr(cache, key, cost, self.timeout)
+        full = now - (consumed - cost) / self.rate
+
+        epoch = self.epochs.get(ident)
+        if epoch is None or epoch < full:
+            # Unknown or (locally) full bucket, check the shared epoch.
+            epoch = self.load_epoch(cache, ident, full)
+            if epoch < full:
+                # Drop the credit earned while idle.
+                epoch = full
+                cache.set('%s:%s:epoch' % (self.key_prefix, ident), epoch, self.timeout)
+                remember(self.epochs, ident, epoch)
+
+        earned = (now - epoch) * self.rate
+        if consumed > earned + self.burst:
+            cache.decr(key, cost)
+            return int(math.ceil((consumed - earned - self.burst) / self.rate))
+        return 0
+
+    def lease_timeout(self, size, now):
+        return size / self.rate
+
+
+def get_ident(request):
+    """ Identifies the client, by user when logged in and by IP otherwise. """
+    if request.user.is_authenticated():
+        return 'user:%s' % request.user.pk
+    return 'ip:%s' % request.META.get('REMOTE_ADDR')
@@ -0,0 +1,110 @@
+"""
+Per request instrumentation of `BaseResource`.
+
+With `REST_API_TIMING = True` in settings, every request is timed by
+phase (clean, handler, construct, encode) with the number of queries
+each phase ran. The result is sent in a `Server-Timing` header and
+given to the sink named by `REST_API_METRICS_SINK`.
+
+With `REST_API_PROFILE_SAMPLE_RATE` (0 to 1), that share of the
+requests runs under cProfile. The stats of those slower than
+`REST_API_PROFILE_THRESHOLD` milliseconds are dumped into
+`REST_API_PROFILE_DIR`.
+"""
+import cProfile
+import os
+import random
+import tempfile
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class MetricsSink(object):
+    """
+    Receives the timings of every timed request. Subclass it and name
+    the subclass in `REST_API_METRICS_SINK`, it is created once.
+    """
+    def record(self, resource, request, response, timer):
+        """
+        `timer.phases` lists (name, milliseconds, queries),
+        `timer.total` is the milliseconds of the whole request.
+        """
+        raise NotImplementedError("Please implement record.")
+
+
+class PhaseTimer(object):
+    """ Times consecutive phases, `lap(name)` ends the current one. """
+    def __init__(self, connection):
+        self.connection = connection
+        self.phases = []
+        self.started = self.last = time.time()
+        self.initial_queries = self.queries = len(connection.queries_log)
+
+    def lap(self, name):
+        now = time.time()
+        queries = len(self.connection.queries_log)
+        self.phases.append((name, (now - self.last) * 1000, queries - self.queries))
+        self.last, self.queries = now, queries
+
+    @property
+    def total(self):
+        return (self.last - self.started) * 1000
+
+    def db_time(self):
+        log = self.connection.queries_log
+        return sum(float(query['time']) for query in islice(log, self.initial_queries, len(log))) * 1000
+
+    def header(self):
+        """ The `Server-Timing` header value. """
+        metrics = ['%s;desc="%d queries";dur=%.1f' % (name, queries, duration)
+                   for name, duration, queries in self.phases]
+        metrics.append('db;desc="%d queries";dur=%.1f' % (self.queries - self.initial_queries, self.db_time()))
+        metrics.append('total;dur=%.1f' % self.total)
+        return ', '.join(metrics)
+
+
+class NullTimer(object):
+    """ Used when timing is off. """
+    phases = ()
+
+    def lap(self, name):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+_sinks = {}
+
+
+def get_sink():
+    """ The `REST_API_METRICS_SINK` instance, or None. """
+    path = getattr(settings, 'REST_API_METRICS_SINK', None)
+    if not path:
+        return None
+    if path not in _sinks:
+        _sinks[path] = import_string(path)()
+    return _sinks[path]
+
+
+def start_profile():
+    """ Returns an enabled profile for a sampled request, otherwise None. """
+    rate = getattr(settings, 'REST_API_PROFILE_SAMPLE_RATE', 0)
+    if not rate or random.random() >= rate:
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def finish_profile(profile, name, duration):
+    """ Dumps the stats of a profiled request which took longer than the threshold. """
+    profile.disable()
+    if duration < getattr(settings, 'REST_API_PROFILE_THRESHOLD', 1000):
+        return None
+    directory = getattr(settings, 'REST_API_PROFILE_DIR', None) or tempfile.gettempdir()
+    filename = os.path.join(directory, '%s-%d-%dms.prof' % (name, time.time() * 1000, duration))
+    profile.dump_stats(filename)
+    return filename
@@ -1,14 +1,18 @@
 import time, math
 import json
+import base64
 import urlparse
 from collections import namedtuple
 
 from datetime import datetime
 from django.contrib.auth.models import User
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.http import QueryDict
 
 import rest_api.errors as api_errors
+from rest_api import json_codec
 from rest_api.errors import GlobalAPIException
+from rest_api.piston.utils import parse_body
 
 # New api django_ct
 TYPE_LIST = ['Unknown', 'auth.user', ]
@@ -19,6 +23,13 @@ MAX_RETURN_NUM = 300
 
 SysRequest = namedtuple('SysRequest', ['user', 'CLEANED', 'is_iphone', 'is_android', 'META'])
 
+# The argument lists of a handler, compiled once by `compile_schema`.
+# create, read - tuples of (name, required, coerce)
+# files - tuple of names
+# delete, form - tuples of (name, coerce)
+# `coerce` converts a present value to its `field_types` type, or is None.
+RequestSchema = namedtuple('RequestSchema', ['create', 'files', 'read', 'delete', 'form'])
+
 
 def create_sys_request(user=None, query_dict=None):
     if not query_dict:
@@ -66,7 +77,7 @@ def process_json(json_str):
             elif type(json_str) == dict:
                 json_obj = json_str
             else:
-                json_obj = json.loads(json_str)
+                json_obj = json_codec.loads(json_str)
 
             return json_obj
     except:
@@ -154,6 +165,90 @@ def process_choices(value, choices):
     return value
 
 
+def _to_int(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, basestring):
+        return int(value.split('.')[0])
+    return int(value)
+
+
+def _to_float(value):
+    if value == '':
+        return None
+    return float(value)
+
+
+def _to_bool(value):
+    if value in ('true', 'True', '1', True, 1):
+        return True
+    if value in ('false', 'False', '0', '', False, 0):
+        return False
+    raise ValueError(value)
+
+
+def _to_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return value.split(',') if value else []
+
+
+def _to_timestamp(value):
+    return datetime.fromtimestamp(float(value))
+
+
+def _to_latlon(value):
+    if isinstance(value, (list, tuple)):
+        value = ','.join(map(unicode, value))
+    return process_latlon(value)
+
+
+# Field types of `BaseHandler.field_types`: name -> (converter, description)
+FIELD_TYPES = {
+    'int': (_to_int, 'integer'),
+    'float': (_to_float, 'float'),
+    'bool': (_to_bool, 'boolean'),
+    'list': (_to_list, 'comma separated list'),
+    'timestamp': (_to_timestamp, 'timestamp'),
+    'latlon': (_to_latlon, 'location'),
+}
+
+
+def make_coercer(name, field_type):
+    """
+    Returns a function converting a value of the argument `name` to
+    `field_type`: a key of FIELD_TYPES or a django style choices
+    sequence, whose (integer) keys are the valid values.
+    """
+    if isinstance(field_type, (list, tuple)):
+        valid = frozenset(choice[0] for choice in field_type)
+
+        def coerce(value):
+            try:
+                value = _to_int(value)
+            except (TypeError, ValueError):
+                value = None
+            if value not in valid:
+                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'%s' is not a valid choice." % name)
+            return value
+        return coerce
+
+    try:
+        convert, description = FIELD_TYPES[field_type]
+    except KeyError:
+        raise ValueError("Unknown field type '%s' for '%s'." % (field_type, name))
+
+    def coerce(value):
+        try:
+            return convert(value)
+        except (TypeError, ValueError, AttributeError, OverflowError):
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'%s' is not a valid %s." % (name, description))
+        except GlobalAPIException, e:
+            # process_latlon explains the problem, say which parameter has it
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'%s': %s" % (name, e.debug))
+    return coerce
+
+
 def wrap_info(response, info):
     return {'_data':response, '_info': info}
 
@@ -173,16 +268,140 @@ def parse_pagination(offset=None, limit=None):
             limit = MAX_RETURN_NUM
     except ValueError:
         raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "The 'offset' and 'limit' must be integer.")
+    # An empty page can't tell has_more
+    if offset < 0 or limit < 1:
+        raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "The 'offset' can't be negative and the 'limit' must be positive.")
     return offset, limit
 
 
+def _cursor_default(obj):
+    # Keep full precision, DjangoJSONEncoder truncates microseconds.
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return unicode(obj)
+
+
+def encode_cursor(values):
+    """ Encodes the ordering key values of the last row into an opaque cursor. """
+    return base64.urlsafe_b64encode(json.dumps(values, default=_cursor_default)).rstrip('=')
+
+
+def cursor_model_fields(model, cursor_fields):
+    """ The model fields of the `cursor_fields` keys, None for keys which aren't one. """
+    result = []
+    for key in cursor_fields:
+        try:
+            result.append(model._meta.get_field(key.lstrip('-')) if model else None)
+        except FieldDoesNotExist:
+            result.append(None)
+    return result
+
+
+def parse_cursor(cursor=None, size=None, fields=None):
+    """
+    Decodes a cursor made by `encode_cursor` into a list of key values,
+    converted by `fields` (model fields, see `cursor_model_fields`).
+    """
+    if not cursor:
+        return None
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "The 'cursor' is not valid.")
+    if type(values) != list or (size is not None and len(values) != size):
+        raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "The 'cursor' is not valid.")
+    if fields:
+        try:
+            values = [field.to_python(value) if field else value for field, value in zip(fields, values)]
+        except (ValidationError, TypeError, ValueError):
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "The 'cursor' is not valid.")
+    return values
+
+
+def unique(items):
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+
+def parse_fields(fields=None, allowed=()):
+    """
+    Parses a comma separated `fields` parameter, every name must be in `allowed`.
+    The names are sorted, so every order of the same fields is the same request.
+    """
+    if not fields:
+        return None
+    names = tuple(sorted(set(name.strip() for name in fields.split(',') if name.strip())))
+    for name in names:
+        if name not in allowed:
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, "'%s' is not a valid field." % name)
+    return names or None
+
+
+def compile_schema(handler):
+    """
+    Compiles the argument tuples and `field_types` of `handler` into a
+    `RequestSchema`. Required fields missing from `create_kwargs` are
+    not checked, as before.
+    """
+    coercers = dict((name, make_coercer(name, field_type))
+                    for name, field_type in handler.field_types.iteritems())
+
+    required = frozenset(handler.required_fields)
+    create = tuple((kwarg, kwarg in required, coercers.get(kwarg)) for kwarg in unique(handler.create_kwargs))
+
+    read_required = unique(handler.required_fields_for_read)
+    read = tuple((kwarg, True, coercers.get(kwarg)) for kwarg in read_required)
+    read_required = frozenset(read_required)
+    read += tuple((kwarg, False, coercers.get(kwarg)) for kwarg in unique(handler.read_kwargs) if kwarg not in read_required)
+
+    return RequestSchema(create=create,
+                         files=tuple(handler.files_kwargs),
+                         read=read,
+                         delete=tuple((kwarg, coercers.get(kwarg)) for kwarg in handler.delete_kwargs),
+                         form=tuple((kwarg, coercers.get(kwarg)) for kwarg in unique(handler.form_fields)))
+
+
+def load_body(request):
+    """ The JSON body of `request`, a malformed one is a BAD_PARA_FORMAT error. """
+    try:
+        return parse_body(request)
+    except ValueError:
+        raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, 'The body should be JSON.')
+
+def clean_create_args(schema, params, query_dict):
+    """ Copies the `create_kwargs` of `params` into `query_dict`, converted to their types. """
+    for kwarg, required, coerce in schema.create:
+        value = params.get(kwarg)
+        if value is None:
+            if required:
+                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'%s' is missing in params." % kwarg)
+        elif coerce:
+            value = coerce(value)
+        query_dict[kwarg] = value
+    return query_dict
+
+
+def clean_bulk_item(cls, request, schema, item, resource_dict, **kwargs):
+    """ Cleans one item of a bulk create, returns (query_dict, None) or (None, error). """
+    try:
+        if type(item) != dict:
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, 'Every item should be an object.')
+        _item = clean_create_args(schema, item, QueryDict('', mutable=True))
+        _item.update(resource_dict)
+        cls.create_validate(_item, request=request, **kwargs)
+    except GlobalAPIException, e:
+        return None, api_errors.error_content(e.code, e.debug)
+    return _item, None
+
+
 def process_request(cls, request, *args, **kwargs):
     user_in_session = request.session.get('user')
 
     if not request.user.is_authenticated():
         if request.method=='GET' and cls.read_auth_exempt:
             pass
-        elif request.method=='POST' and cls.create_auth_exempt:
+        elif request.method in ('POST', 'PATCH') and cls.create_auth_exempt:
             pass
         elif request.method=='DELETE' and cls.delete_auth_exempt:
             pass
@@ -201,13 +420,15 @@ def process_request(cls, request, *args, **kwargs):
     _post_json_dict = {}
     if request.META.get('CONTENT_TYPE')=="application/json":
         if request.body:
-            _post_json_dict = json.loads(request.body)
+            _post_json_dict = load_body(request)
 
     _resource_dict = cls.auth_resource(request=request, json_dict=_post_json_dict, **kwargs)
     if not _resource_dict:
         _resource_dict = {}
     _resource_dict['request_user'] = request.user
 
+    schema = cls.request_schema()
+
     # Validate Create Args
     if request.method == 'POST':
         _post = QueryDict('', mutable=True)
@@ -217,20 +438,24 @@ def process_request(cls, request, *args, **kwargs):
         content_type = request.META.get('CONTENT_TYPE', '')
         if "application/json" in content_type or content_type == '':
             if request.body:
-                json_dict = json.loads(request.body)
-                for kwarg in cls.create_kwargs:
-                    if json_dict.get(kwarg) == None and kwarg in cls.required_fields:
-                        raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'%s' is missing in params." % kwarg)
-                    _post[kwarg] = json_dict.get(kwarg)
+                json_dict = load_body(request)
+                # Bulk create, every item is cleaned and validated on its own
+                if type(json_dict) == list:
+                    # Only IndexHandlers (with bulk_create) take a list
+                    if not getattr(cls, 'bulk_create_size', 0) or not hasattr(cls, 'bulk_create'):
+                        raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, 'Bulk create is not supported.')
+                    if len(json_dict) > cls.bulk_max_items:
+                        raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, 'At most %d items in a bulk create.' % cls.bulk_max_items)
+                    request.BULK = [clean_bulk_item(cls, request, schema, item, _resource_dict, **kwargs) for item in json_dict]
+                    _post.update(_resource_dict)
+                    request.CLEANED = _post
+                    return request
+                clean_create_args(schema, json_dict, _post)
         # For XML
         else:
-            _REQUEST_POST = dict(urlparse.parse_qsl(request.body))
-            for kwarg in cls.create_kwargs:
-                if _REQUEST_POST.get(kwarg) == None and kwarg in cls.required_fields:
-                    raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'%s' is missing in params." % kwarg)
-                _post[kwarg] = _REQUEST_POST.get(kwarg)
+            clean_create_args(schema, dict(urlparse.parse_qsl(request.body)), _post)
         # FILE parameters
-        for kwarg in cls.files_kwargs:
+        for kwarg in schema.files:
             if request.FILES.get(kwarg) == None and request.POST.get('file64') == None:
                 raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'%s' is missing in upload file request." % kwarg)
             _post[kwarg] = request.FILES.get(kwarg)
@@ -244,16 +469,25 @@ def process_request(cls, request, *args, **kwargs):
         _get['order_by'] = request.GET.get('order_by')
         _get['endpoint'] = _get['offset'] + _get['limit']
         _get['detail'] = request.GET.get('detail')=='true'
-        
-        for required_field in cls.required_fields_for_read:
-            if required_field not in request.GET:
-                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'%s' is missing in params." % required_field)
-            else:
-                _get[required_field] = request.GET.get(required_field)
-                
-        for kwarg in cls.read_kwargs:
-            if request.GET.get(kwarg) != None:
-                _get[kwarg] = request.GET.get(kwarg)
+
+        # Keyset pagination, the cursor takes the place of offset
+        if cls.cursor_fields:
+            _get['cursor'] = parse_cursor(request.GET.get('cursor'), len(cls.cursor_fields),
+                                          cursor_model_fields(cls.query_model, cls.cursor_fields))
+            if _get['cursor'] is not None:
+                _get['offset'] = 0
+                _get['endpoint'] = _get['limit']
+
+        # Sparse fieldsets, only the whitelisted fields can be asked for
+        if cls.sparse_fields:
+            _get['fields'] = parse_fields(request.GET.get('fields'), cls.sparse_fields)
+
+        for kwarg, required, coerce in schema.read:
+            value = request.GET.get(kwarg)
+            if value is not None:
+                _get[kwarg] = coerce(value) if coerce else value
+            elif required:
+                raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_SIGNATURE, "'%s' is missing in params." % kwarg)
         _get.update(_resource_dict)
         cls.read_validate(_get, request=request, **kwargs)
         request.CLEANED = cls.map_para(_get)
@@ -261,12 +495,29 @@ def process_request(cls, request, *args, **kwargs):
     elif request.method == 'DELETE':
         _delete = QueryDict(request.body, mutable=True)
 
-        for kwarg in cls.delete_kwargs:
-            if not _delete.get(kwarg):
-                _delete[kwarg] = request.GET.get(kwarg)
+        for kwarg, coerce in schema.delete:
+            value = _delete.get(kwarg)
+            if not value:
+                value = _delete[kwarg] = request.GET.get(kwarg)
+            if coerce and value is not None:
+                _delete[kwarg] = coerce(value)
 
         _delete.update(_resource_dict)
         cls.delete_validate(_delete, request=request, **kwargs)
         request.CLEANED = _delete
+    # Validate Partial Update Args, only form_fields can be changed
+    elif request.method == 'PATCH':
+        _patch = QueryDict('', mutable=True)
+        params = load_body(request) if request.body else {}
+        if type(params) != dict:
+            raise GlobalAPIException(api_errors.ERROR_GENERAL_BAD_PARA_FORMAT, 'The changes should be an object.')
+        for kwarg, coerce in schema.form:
+            value = params.get(kwarg)
+            if value is not None:
+                _patch[kwarg] = coerce(value) if coerce else value
+
+        _patch.update(_resource_dict)
+        cls.update_validate(_patch, request=request, **kwargs)
+        request.CLEANED = _patch
 
     return request